@@ -0,0 +1,283 @@
+"""Install uploaded app packages in the background.
+
+An app package is a zip file of one or more app folders, each holding a
+plugin.xml. An upload is saved to <install path>/.installs/<install id>.zip,
+and a background thread then
+
+    checks the package: safe paths, its size, CRCs, a loadable plugin.xml
+    extracts it into .installs/<install id>/
+    moves its folders into the install path, replacing earlier versions
+    appends the folders to the change log, .app_changes.log
+
+How far an installation got is kept in .installs/<install id>.json, so any
+web worker can answer for it. Every worker follows the change log (see
+ChangeLog) and registers only the apps in the folders named there.
+"""
+import os
+import re
+import json
+import stat
+import time
+import uuid
+import fcntl
+import Queue
+import shutil
+import logging
+import zipfile
+import threading
+
+
+log = logging.getLogger(__name__)
+
+INSTALLS_FOLDER = '.installs'
+CHANGES_FILE = '.app_changes.log'
+LOCK_FILE = '.lock'
+CHUNK_SIZE = 1024 * 1024
+
+# Left out of packages, as added by the archive utility of macOS
+IGNORED_ENTRIES = ('__MACOSX',)
+
+INSTALL_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class ChangeLog(object):
+    """Folders of the plugin tree which were installed, one JSON line per
+    installation:
+
+        {"t": 1458820000.1, "folders": ["my_app"]}
+
+    A reader only reads what was appended since it last looked, so finding
+    out that nothing changed costs a stat.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # Everything installed so far is found by the initial scan
+        self.offset = self._size()
+
+    def _size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def record(self, folders):
+        line = json.dumps(dict(t=time.time(), folders=folders)) + '\n'
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def read_new(self):
+        """Return the folders installed since the last call.
+        """
+        with self._lock:
+            size = self._size()
+            if size == self.offset:
+                return []
+            if size < self.offset:
+                # Replaced by an empty log, nothing was missed
+                self.offset = 0
+            with open(self.path, 'r') as f:
+                f.seek(self.offset)
+                data = f.read(size - self.offset)
+            # A line still being written is read next time
+            data = data[:data.rfind('\n') + 1]
+            self.offset += len(data)
+
+        folders = []
+        for line in data.splitlines():
+            try:
+                folders.extend(json.loads(line)['folders'])
+            except (ValueError, KeyError):
+                log.warning("Ignoring unreadable line of app change log %s",
+                            self.path)
+        return folders
+
+
+class AppInstaller(object):
+    """Install app packages into `install_path` in a background thread.
+
+    `load_app` is called with the path of every plugin.xml of a package
+    before it is installed and must raise if the app cannot be loaded;
+    `installed` is called with the names of the folders installed.
+    Packages unpacking to more than `max_size` bytes are refused.
+    """
+
+    def __init__(self, install_path, load_app, installed=None, max_size=None):
+        self.install_path = install_path
+        self.load_app = load_app
+        self.installed = installed
+        self.max_size = max_size
+        self.root = os.path.join(install_path, INSTALLS_FOLDER)
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        self.changes = ChangeLog(os.path.join(install_path, CHANGES_FILE))
+        self._pending = Queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start the install thread. Like JobEventFeed, this is done lazily
+        so it happens after a pre-forking server has forked.
+        """
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='app-installer')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def submit(self, stream, filename):
+        """Save the package read from `stream` and queue it for installation.
+        Returns the install id.
+        """
+        install_id = uuid.uuid4().hex
+        with open(self._path(install_id, '.zip'), 'wb') as package:
+            shutil.copyfileobj(stream, package, CHUNK_SIZE)
+        self._set_status(install_id, state='queued', filename=filename,
+                         submitted_at=time.strftime('%Y-%m-%d %H:%M:%S'))
+        self._pending.put((install_id, filename))
+        self.start()
+        return install_id
+
+    def status(self, install_id):
+        """What became of the installation `install_id`, or an empty dict if
+        there is no such installation.
+        """
+        if INSTALL_ID.match(install_id or '') is None:
+            return dict()
+        try:
+            with open(self._path(install_id, '.json'), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return dict()
+
+    def _path(self, install_id, suffix=''):
+        return os.path.join(self.root, install_id + suffix)
+
+    def _set_status(self, install_id, **status):
+        current = self.status(install_id)
+        current.update(status, id=install_id)
+        tmppath = self._path(install_id, '.json.tmp')
+        with open(tmppath, 'w') as f:
+            json.dump(current, f)
+        os.rename(tmppath, self._path(install_id, '.json'))
+
+    def _run(self):
+        while True:
+            install_id, filename = self._pending.get()
+            try:
+                self.install(install_id, filename)
+            except Exception as e:
+                log.exception("App package %s could not be installed.",
+                              filename)
+                self._set_status(install_id, state='failed', error=str(e),
+                                 finished_at=time.strftime('%Y-%m-%d %H:%M:%S'))
+            finally:
+                shutil.rmtree(self._path(install_id), ignore_errors=True)
+                if os.path.exists(self._path(install_id, '.zip')):
+                    os.remove(self._path(install_id, '.zip'))
+
+    def install(self, install_id, filename):
+        self._set_status(install_id, state='installing')
+        started = time.time()
+        staging = self._path(install_id)
+
+        with zipfile.ZipFile(self._path(install_id, '.zip'), 'r') as zf:
+            names = self.check_package(zf)
+            extract_to = staging
+            # Loose files at the top are kept in a folder named after the
+            # package, so they do not end up in the install path itself
+            if any('/' not in name for name in names):
+                base = os.path.splitext(os.path.basename(filename))[0]
+                if not base or base.startswith('.'):
+                    raise ValueError("Cannot name a folder after package %s."
+                                     % filename)
+                extract_to = os.path.join(staging, base)
+            for name in names:
+                zf.extract(name, extract_to)
+
+        folders = sorted(os.listdir(staging))
+        apps = []
+        for folder in folders:
+            for proot, pfolders, pfiles in os.walk(os.path.join(staging,
+                                                                folder)):
+                if 'plugin.xml' not in pfiles:
+                    continue
+                pxml = os.path.join(proot, 'plugin.xml')
+                try:
+                    apps.append(self.load_app(pxml))
+                except Exception as e:
+                    raise ValueError("Cannot load %s: %s" % (
+                        os.path.relpath(pxml, staging), e))
+
+        # Only one installation replaces folders at a time, in any worker
+        with open(os.path.join(self.root, LOCK_FILE), 'w') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            moved = []
+            try:
+                for folder in folders:
+                    self._replace(os.path.join(staging, folder),
+                                  os.path.join(self.install_path, folder),
+                                  install_id)
+                    moved.append(folder)
+            finally:
+                if moved:
+                    self.changes.record(moved)
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+        if self.installed is not None:
+            self.installed(folders)
+        self._set_status(install_id, state='installed', folders=folders,
+                         apps=[app.unique_id for app in apps],
+                         finished_at=time.strftime('%Y-%m-%d %H:%M:%S'))
+        log.info("Installed %s apps from %s in %.1fs", len(apps), filename,
+                 time.time() - started)
+
+    def check_package(self, zf):
+        """Return the names of the entries of the package in `zf` which are
+        to be extracted, or raise a ValueError if it must not be installed.
+        """
+        names = []
+        size = 0
+        for info in zf.infolist():
+            parts = info.filename.split('/')
+            if parts[0] in IGNORED_ENTRIES:
+                continue
+            if info.filename.startswith('/') or '\\' in info.filename or \
+                    '..' in parts or ':' in parts[0] or \
+                    parts[0].startswith('.'):
+                raise ValueError("Package entry %s would be extracted outside "
+                                 "of its folder." % info.filename)
+            if stat.S_ISLNK(info.external_attr >> 16):
+                raise ValueError("Package entry %s is a symbolic link."
+                                 % info.filename)
+            size += info.file_size
+            names.append(info.filename)
+
+        if self.max_size is not None and size > self.max_size:
+            raise ValueError("Package unpacks to %s bytes, more than the "
+                             "limit of %s." % (size, self.max_size))
+        if not any(name.split('/')[-1] == 'plugin.xml' for name in names):
+            raise ValueError("Package holds no plugin.xml.")
+        corrupt = zf.testzip()
+        if corrupt is not None:
+            raise ValueError("Package entry %s is corrupt." % corrupt)
+        return names
+
+    def _replace(self, source, target, install_id):
+        """Move the folder `source` to `target`, replacing what was there.
+        """
+        if os.path.lexists(target):
+            replaced = self._path(install_id, '.replaced')
+            if not os.path.isdir(replaced):
+                os.mkdir(replaced)
+            old = os.path.join(replaced, os.path.basename(target))
+            os.rename(target, old)
+            os.rename(source, target)
+            shutil.rmtree(replaced, ignore_errors=True)
+        else:
+            os.rename(source, target)
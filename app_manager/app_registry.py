@@ -2,15 +2,41 @@ import os
 import sys
 import glob
 import uuid
+import shlex
 import logging
+import time
 import hashlib
+import threading
+
+from multiprocessing.pool import ThreadPool
 
 from lxml import etree
 from datetime import datetime
 from dateutil import parser as date_parser
 
 from hydra_base import config
-import tempfile
+
+from job_index import JobIndex, STATE_FOLDERS
+from job_file import DEFAULT_PRIORITY, DEFAULT_RESOURCES, MANIFEST_VERSION, \
+        parse_priority, parse_resources, parse_timestamp, read_manifest, \
+        format_job_file
+from journal import Journal
+from job_batch import batch_marker
+from metrics import REGISTRY, JOB_WAIT, JOB_RUN, timed
+from run_info import RUN_INFO_SUFFIX, read_run_info
+from queue_notify import notify
+from job_events import JobEventFeed
+from log_tail import read_from, tail_lines, scan_markers, MarkerState, \
+        READ_SIZE
+from artifact_cache import CachedArtifact, gzip_file
+from app_utilities import filter_native_log
+from registry_cache import RegistryCache
+from result_cache import ResultCache
+from app_install import AppInstaller, ChangeLog, CHANGES_FILE, INSTALLS_FOLDER
+from retention import RetentionEngine
+from job_query import SortedIndex, sort_key, iter_descending, \
+        encode_cursor, decode_cursor
+from sweep import sweep_size, iter_sweep, batches
 
 
 log = logging.getLogger(__name__)
@@ -24,15 +50,56 @@ class AppInterface(object):
 
         self.app_registry = AppRegistry()
         self.job_queue = JobQueue(config.get('plugin', 'queue_directory', '/tmp'))
+        self.job_queue.persist_output_state = \
+                str(config.get('plugin', 'persist_output_state', False)).lower() == 'true'
+        self.job_queue.scan_threads = int(config.get('plugin', 'scan_threads', 16))
+        if str(config.get('plugin', 'result_cache', False)).lower() == 'true':
+            self.job_queue.result_cache = ResultCache(
+                os.path.join(self.job_queue.root, self.job_queue.folders['cache'], 'results'),
+                max_age=float(config.get('plugin', 'result_cache_max_age', 7)) * 86400,
+                max_size=int(config.get('plugin', 'result_cache_size', 1024)) * 2**20)
         self.job_queue.rebuild(self.app_registry)
+        self.retention = RetentionEngine(
+            self.job_queue,
+            max_age=self._config_number('retention_days', None, float),
+            per_user=self._config_number('retention_per_user', None, int),
+            max_size=self._config_number('retention_size', None, int),
+            interval=self._config_number('retention_interval', 3600, float))
+        if self.retention.max_size is not None:
+            self.retention.max_size *= 2**20
+        self.installer = None
+        if self.app_registry.install_path is not None:
+            max_app_size = self._config_number('max_app_size', 1024, int)
+            self.installer = AppInstaller(
+                self.app_registry.install_path, load_app=lambda pxml: App(pxml=pxml),
+                installed=lambda folders: self.app_registry.sync(),
+                max_size=max_app_size * 2**20 if max_app_size is not None else None)
         self.upload_dir = config.get('plugin', 'upload_dir', '/tmp/uploads')
+        self.job_events = JobEventFeed(self._poll_job_events,
+                                       fileno=self.job_queue.index.fileno)
+        self._outfile_sizes = dict()
+        # Collected only once the event feed runs, see _poll_job_events
+        self._changes = None
+        self._running = set()
+        self.job_queue.listeners.append(self._observe_jobs)
+        REGISTRY.gauge('appmanager_jobs', "Number of jobs in each state folder.",
+                       ['state'], collect=self._count_jobs)
+
+    def _config_number(self, option, default, convert):
+        """A number from the plugin config, where 'none' or an empty value
+        means no limit.
+        """
+        value = config.get('plugin', option, default)
+        if value is None or str(value).strip().lower() in ('', 'none'):
+            return None
+        return convert(value)
 
     def installed_apps_as_dict(self):
         """Return a list if installed apps as dict.
         """
         
         installedapps = []
-        for key, app in self.app_registry.installed_apps.iteritems():
+        for key, app in self.app_registry.sync().iteritems():
             appinfo = dict(id=key,
                            name=app.info['name'],
                            description=app.info['description'],
@@ -42,20 +109,109 @@ class AppInterface(object):
         return installedapps
 
     def app_info(self, app_id):
-        return self.app_registry.installed_apps[app_id].info
+        return self.app_registry.sync()[app_id].info
+
+    def install_app(self, stream, filename):
+        """Save an uploaded app package and install it in the background (see
+        app_install.py). Returns the install id.
+        """
+        if self.installer is None:
+            raise Exception("Plugin folder not defined in config.ini, cannot install apps.")
+        return self.installer.submit(stream, filename)
+
+    def install_status(self, install_id):
+        if self.installer is None:
+            return {}
+        return self.installer.status(install_id)
 
-    def run_app(self, app_id, network_id, scenario_id, user, options={}, network_name='', scenario_name=''):
-        app = self.app_registry.installed_apps[app_id]
+    def run_app(self, app_id, network_id, scenario_id, user, options={}, network_name='', scenario_name='', priority=None):
+        app = self.app_registry.sync()[app_id]
         appjob = Job()
-        appjob.create(app, app_id, network_id, scenario_id, str(user), options, scenario_name=scenario_name, network_name=network_name)
+        appjob.create(app, app_id, network_id, scenario_id, str(user), options, scenario_name=scenario_name, network_name=network_name, priority=priority)
         self.job_queue.enqueue(app_id, appjob)
         return dict(jobid=appjob.id)
 
+    def run_batch(self, app_id, network_id, scenario_ids, user, options={}, network_name='', scenario_names=None, priority=None):
+        """Run an app for several scenarios in one go. All commands are built
+        before the jobs are queued together. Returns the ids of all jobs, in
+        the order of `scenario_ids`.
+        """
+        app = self.app_registry.sync()[app_id]
+        if scenario_names is None or isinstance(scenario_names, basestring):
+            scenario_names = [scenario_names or ''] * len(scenario_ids)
+        elif len(scenario_names) != len(scenario_ids):
+            raise Exception("Got %s scenario names for %s scenarios."%(len(scenario_names), len(scenario_ids)))
+
+        appjobs = []
+        for scenario_id, scenario_name in zip(scenario_ids, scenario_names):
+            appjob = Job()
+            appjob.create(app, app_id, network_id, scenario_id, str(user), options, scenario_name=scenario_name, network_name=network_name, priority=priority)
+            appjobs.append(appjob)
+
+        self.job_queue.enqueue_many(appjobs)
+        return dict(jobids=[appjob.id for appjob in appjobs])
+
+    def run_sweep(self, app_id, network_id, scenario_ids, user, options={}, network_name='', scenario_names=None, batch_size=100, priority=None):
+        """Run an app for every combination of the given scenarios and option
+        values (see sweep.py for how values are given). The jobs are created
+        and queued in batches of `batch_size` and share a sweep id, which can
+        be passed to `get_sweep_status`.
+        """
+        app = self.app_registry.sync()[app_id]
+
+        total = sweep_size(scenario_ids, options)
+        max_jobs = int(config.get('plugin', 'max_sweep_jobs', 10000))
+        if total > max_jobs:
+            raise Exception("A sweep of %s jobs exceeds the limit of %s jobs."%(total, max_jobs))
+
+        if scenario_names is None or isinstance(scenario_names, basestring):
+            scenario_names = [scenario_names or ''] * len(scenario_ids)
+        scenario_names = dict(zip(scenario_ids, scenario_names))
+
+        sweep_id = uuid.uuid4().hex
+        log.info("Starting sweep %s of app %s with %s jobs", sweep_id, app_id, total)
+
+        for batch in batches(iter_sweep(scenario_ids, options), batch_size):
+            appjobs = []
+            for scenario_id, job_options in batch:
+                appjob = Job()
+                appjob.create(app, app_id, network_id, scenario_id, str(user), job_options, scenario_name=scenario_names[scenario_id], network_name=network_name, sweep_id=sweep_id, priority=priority)
+                appjobs.append(appjob)
+            self.job_queue.enqueue_many(appjobs)
+
+        return dict(sweep_id=sweep_id, jobs=total)
+
+    def get_sweep_status(self, sweep_id):
+        """Return the number of jobs of a sweep in each state and the overall
+        progress of the sweep, counting finished and failed jobs as complete
+        and running jobs by the progress they report.
+        """
+        self.job_queue.refresh(self.app_registry)
+
+        counts = dict()
+        done = 0.0
+        jobs = [self.job_queue.jobs[jid] for jid in self.job_queue.sweeps.get(sweep_id, ())]
+        for job in jobs:
+            status = job.status
+            counts[status] = counts.get(status, 0) + 1
+            if status in ('finished', 'failed'):
+                done += 1
+            elif status == 'running':
+                progress, total = job.get_progress()
+                if total:
+                    done += min(float(progress) / total, 1)
+
+        return dict(sweep_id=sweep_id,
+                    jobs=len(jobs),
+                    counts=counts,
+                    progress=done / len(jobs) if jobs else None)
+
+    @timed('get_status')
     def get_status(self, network_id=None, user_id=None, job_id=None):
         "Return the status of matching jobs."
 
-        self.job_queue.rebuild(self.app_registry)
         if job_id is not None:
+            self.job_queue.refresh(self.app_registry)
             if job_id in self.job_queue.jobs.keys():
                 return [dict(jobid=job_id,
                              app_id=self.job_queue.jobs[job_id].app_id,
@@ -63,22 +219,114 @@ class AppInterface(object):
             else:
                 return []
         else:
-            matching_jobs = []
-            for jid, job in self.job_queue.jobs.iteritems():
-                if network_id is not None and user_id is not None:
-                    if int(job.network_id) == int(network_id) and int(job.owner) == int(user_id): 
-                        matching_jobs.append(job)
-                elif network_id is not None:
-                    if int(job.network_id) == int(network_id):
-                        matching_jobs.append(job)
-                elif user_id is not None:
-                    if int(job.owner) == int(user_id):
-                        matching_jobs.append(job)
-
-            response = []
-            for job in sorted(matching_jobs, key=lambda x:x.enqueued_at, reverse=True):
-                response.append(dict(scenario_id=job.scenario_id, network_id=job.network_id, owner=job.owner, app_id=job.app_id, jobid=job.id, status=job.status, scenario_name=job.scenario_name, network_name=job.network_name, started_at=job.enqueued_at.strftime('%d/%m/%Y - %H:%M:%S')))
-            return response
+            rows, cursor = self.query_status(network_id=network_id, user_id=user_id)
+            return rows
+
+    def query_status(self, network_id=None, user_id=None, app_id=None, status=None, since=None, until=None, cursor=None, limit=None):
+        """Return one page of the status of the jobs of a network and/or
+        user, most recently queued first, and the cursor of the next page
+        (None on the last page). `since` and `until` bound the time the jobs
+        were queued, as in '2016-03-01 12:00'.
+        """
+        if network_id is None and user_id is None:
+            return [], None
+
+        self.retention.start()
+        with self.job_queue.lock:
+            self.job_queue.refresh(self.app_registry)
+            jobs, next_cursor = self.job_queue.query(
+                owner=user_id, network_id=network_id, app_id=app_id,
+                status=status,
+                since=date_parser.parse(since) if since else None,
+                until=date_parser.parse(until) if until else None,
+                cursor=cursor, limit=limit)
+            return [self._status_row(job) for job in jobs], next_cursor
+
+    def get_archived_jobs(self, network_id=None, user_id=None, since=None, until=None, limit=None):
+        """Return the metadata of archived jobs of a network and/or user,
+        optionally limited to jobs queued between `since` and `until`, as in
+        '2016-03-01'.
+        """
+        return self.retention.index.query(owner=user_id, network_id=network_id, since=since, until=until, limit=limit)
+
+    def _status_row(self, job, status=None):
+        return dict(scenario_id=job.scenario_id, network_id=job.network_id, owner=job.owner, app_id=job.app_id, jobid=job.id, status=status or job.status, scenario_name=job.scenario_name, network_name=job.network_name, priority=job.priority, cached_from=job.cached_from, started_at=job.enqueued_at.strftime('%d/%m/%Y - %H:%M:%S'), run=job.run_info(status or job.status))
+
+    def _count_jobs(self):
+        """The number of jobs in each state folder, for the metrics, as of the
+        last refresh. Refreshing here could make a scrape list the whole queue.
+        """
+        with self.job_queue.lock:
+            return dict(((folder,), len(self.job_queue.by_status.get(folder)))
+                        for folder in STATE_FOLDERS)
+
+    def _observe_jobs(self, changes):
+        """Record how long jobs which this process sees ending waited and
+        ran. The times are taken from the run info of the queue runner, as a
+        refresh may see a job only once it has ended.
+        """
+        for job, old, new in changes:
+            if job is None or old is None or new not in ('finished', 'failed'):
+                continue
+            info = job.run_info(new)
+            try:
+                started_at = parse_timestamp(info.get('started_at'))
+                ended_at = parse_timestamp(info.get('ended_at'))
+            except ValueError:
+                continue
+            if started_at is None:
+                # Finished from the result cache, it never ran
+                continue
+            if job.enqueued_at is not None:
+                JOB_WAIT.observe((started_at - job.enqueued_at).total_seconds(), app_id=job.app_id)
+            if ended_at is not None:
+                JOB_RUN.observe((ended_at - started_at).total_seconds(), app_id=job.app_id, status=new)
+
+    def _poll_job_events(self):
+        """Refresh the job queue and return what changed since the last call
+        as a list of (event type, status row) pairs. A 'status' event is sent
+        for every job which changed folder (with status 'deleted' for jobs that
+        have gone), a 'progress' event whenever the output of a running job
+        has grown.
+        """
+        with self.job_queue.lock:
+            if self._changes is None:
+                # First poll of the feed thread. Nothing drains the changes
+                # before, so they are only collected from now on.
+                self._changes = []
+                self.job_queue.listeners.append(self._changes.extend)
+                self._running = set(jid for jid, job in self.job_queue.jobs.items()
+                                    if job.status == 'running')
+            self.job_queue.refresh(self.app_registry)
+            changes, self._changes[:] = list(self._changes), []
+
+        events = []
+        for job, old, new in changes:
+            if job is None:
+                continue
+            events.append(('status', self._status_row(job, new or 'deleted')))
+            if new == 'running':
+                self._running.add(job.id)
+            else:
+                self._running.discard(job.id)
+
+        sizes = dict()
+        for jid in list(self._running):
+            job = self.job_queue.jobs.get(jid)
+            if job is None:
+                self._running.discard(jid)
+                continue
+            try:
+                sizes[job.id] = os.path.getsize(job.outfile)
+            except OSError:
+                continue
+            if sizes[job.id] != self._outfile_sizes.get(job.id):
+                row = self._status_row(job)
+                row['progress'] = job.get_progress()
+                events.append(('progress', row))
+        self._outfile_sizes = sizes
+
+        return events
 
     def get_native_logs(self, job_id):
         """
@@ -99,6 +347,7 @@ class AppInterface(object):
         else:
             return {}
 
+    @timed('get_job_details', size=lambda details: len(details.get('logs', ())))
     def get_job_details(self, job_id):
         """
             Return the status of matching jobs.
@@ -108,28 +357,39 @@ class AppInterface(object):
         else:
             return {}
 
+    def tail_job(self, job_id, log_offset=None, out_offset=0, limit=100):
+        """
+            Return what a job has logged and output since the given offsets.
+        """
+        if job_id in self.job_queue.jobs:
+            return self.job_queue.jobs[job_id].tail(log_offset=log_offset,
+                                                    out_offset=out_offset,
+                                                    limit=limit)
+        else:
+            return {}
+
     def delete_job(self, job_id):
         """
             Delete a job by removing it from the queued / finished / failed folder
         """
-        if job_id not in self.job_queue.jobs:
+        self.job_queue.refresh(self.app_registry)
+        job = self.job_queue.jobs.get(job_id)
+        if job is None:
             raise Exception("Cannot delete job %s, Job not found."%job_id)
-
-        job = self.job_queue.jobs[job_id]
         
         job.delete()
 
-        del(self.job_queue.jobs[job_id])
+        self.job_queue.forget(job_id)
 
     def restart_job(self, job_id):
         """
             Restart a job by removing it from the finished / failed folder
             to the queued folder
         """
-        if job_id not in self.job_queue.jobs:
+        self.job_queue.refresh(self.app_registry)
+        job = self.job_queue.jobs.get(job_id)
+        if job is None:
             raise Exception("Cannot restart job %s, Job not found."%job_id)
-
-        job = self.job_queue.jobs[job_id]
         
         job.restart()
 
@@ -144,34 +404,78 @@ class AppRegistry(object):
     def __init__(self):
         """Initialise job queue and similar...
         """
+        self.installed_apps = dict()
+        self.changes = None
+        self._sync_lock = threading.Lock()
         self.install_path = config.get('plugin', 'default_directory')
         if self.install_path is None:
             log.critical("Plugin folder not defined in config.ini! "
                          "Cannot scan for installed plugins.")
             return None
-        self.installed_apps = scan_installed_apps(self.install_path)
+        self.cache = RegistryCache(config.get('plugin', 'registry_cache',
+            os.path.join(self.install_path, '.registry_cache.json')))
+        # Opened before the scan, so nothing installed during it is missed
+        self.changes = ChangeLog(os.path.join(self.install_path, CHANGES_FILE))
+        self.installed_apps = scan_installed_apps(self.install_path,
+                                                  cache=self.cache)
 
     def scan_apps(self):
         """Manually scan for new apps.
         """
 
-        self.installed_apps = scan_installed_apps(self.install_path)
+        self.installed_apps = scan_installed_apps(self.install_path,
+                                                  cache=self.cache)
+
+    def sync(self):
+        """Register the apps of the folders installed since the last sync,
+        by this or any other web worker, and return the installed apps.
+        """
+        if self.changes is None:
+            return self.installed_apps
+        with self._sync_lock:
+            folders = self.changes.read_new()
+            if folders:
+                self.update(folders)
+        return self.installed_apps
+
+    def update(self, folders):
+        """Register the apps in `folders` of the install path anew, without
+        scanning anything else. Apps which were in these folders before are
+        dropped.
+        """
+        paths = [os.path.join(self.install_path, folder) for folder in folders]
+        installed_apps = dict((key, app) for key, app in self.installed_apps.items()
+                              if not any(app.pxml.startswith(path + os.sep)
+                                         for path in paths))
+        plugin_files = []
+        for path in paths:
+            plugin_files.extend(find_plugin_files(path))
+        installed_apps.update(load_apps(plugin_files, cache=self.cache))
+        self.cache.save()
+        # Replaced in one go, readers never see a partial update
+        self.installed_apps = installed_apps
+        log.info("Registered apps in %s, %s apps installed", ', '.join(folders),
+                 len(installed_apps))
 
 
 class App(object):
     """A class representing an installed App.
     """
 
-    def __init__(self, pxml=None):
+    def __init__(self, pxml=None, cached=None):
         self.info = dict()
-        self._from_xml(pxml=pxml)
+        if cached is not None:
+            self._from_cache(pxml, cached)
+        else:
+            self._from_xml(pxml=pxml)
+        self._compile_switches()
 
     @property
     def unique_id(self):
-        """Create a persistent and unique ID for the app.
+        """A persistent and unique ID for the app: the hash of its plugin.xml,
+        computed when the file is loaded.
         """
-        with open(self.pxml, 'r') as pluginfile:
-            return hashlib.md5(pluginfile.read()).hexdigest()
+        return self._unique_id
 
     def default_parameters(self):
         """Return default parameters defined in plugin.xml
@@ -182,6 +486,22 @@ class App(object):
         """Generate a command line command based on the network and scenario ids
         and a given set of options.
         """
+        return ' '.join("'%s'" % element if quoted else element for element, quoted
+                        in self._command_elements(network_id, scenario_id, options))
+
+    def cli_args(self, app_id, network_id, scenario_id, options):
+        """The command line of `cli_command` as a list of arguments, which
+        the queue runner executes without a shell.
+        """
+        elements = self._command_elements(network_id, scenario_id, options)
+        # The plugin shell may come with options of its own, as in 'python -u'
+        return shlex.split(elements[0][0]) + \
+            [element for element, quoted in elements[1:]]
+
+    def _command_elements(self, network_id, scenario_id, options):
+        """The elements of the command line, with whether the shell command
+        quotes them.
+        """
         command_elements = []
         command_elements.append(self.shell)
         command_elements.append(os.path.join(self.location, self.command))
@@ -194,28 +514,31 @@ class App(object):
         command_elements.append(str(network_id))
         command_elements.append(scenid_switch)
         command_elements.append(str(scenario_id))
+        command_elements = [(element, False) for element in command_elements]
 
-        for opt, val in options.iteritems():
-            opt_switch = self._get_switch(opt)
+        # Sorted, so the same options always give the same command
+        for opt in sorted(options):
+            val = options[opt]
 
             # Handle true/false switches
-            for arg in self.info['switches']:
-                if arg['name'] == opt:
-                    if val is True:
-                        command_elements.append(arg['switch'])
+            if val is True:
+                command_elements.extend((flag, False) for flag in self._flags.get(opt, ()))
 
+            opt_switch = self._get_switch(opt)
             if opt_switch is not None:
-                command_elements.append(opt_switch)
-                command_elements.append("'%s'"%(val))
+                command_elements.append((opt_switch, False))
+                command_elements.append(('%s' % (val,), True))
 
-        return ' '.join(command_elements)
+        return command_elements
 
     def _from_xml(self, pxml=None):
         """Initialise app info from a given plugin.xml file.
         """
         self.pxml = pxml
         with open(self.pxml, 'r') as pluginfile:
-            xmlroot = etree.parse(pluginfile).getroot()
+            pluginxml = pluginfile.read()
+        self._unique_id = hashlib.md5(pluginxml).hexdigest()
+        xmlroot = etree.fromstring(pluginxml)
 
         log.debug("Loading xml: %s." % self.pxml)
 
@@ -231,6 +554,11 @@ class App(object):
                 self._parse_args(xmlroot.find('switches'), isswitch=True)
         self.info['nativelogextension'] = xmlroot.find('plugin_nativelogextension').text
         self.info['nativeoutputextension'] = xmlroot.find('plugin_nativeoutputextension').text
+        self.info['resources'] = \
+                self._parse_resources(xmlroot.find('plugin_resources'))
+        cacheable = xmlroot.find('plugin_cacheable')
+        self.info['cacheable'] = cacheable is not None and \
+                (cacheable.text or '').strip().lower() == 'true'
 
         # Private properties
         self.command = xmlroot.find('plugin_command').text
@@ -238,6 +566,40 @@ class App(object):
         self.location = os.path.join(os.path.dirname(pxml),
                                      xmlroot.find('plugin_location').text)
 
+    def _to_cache(self):
+        """The state of the app as stored in the registry cache.
+        """
+        return dict(info=self.info, command=self.command, shell=self.shell,
+                    location=self.location, unique_id=self._unique_id)
+
+    def _from_cache(self, pxml, cached):
+        """Initialise app from a registry cache entry made by `_to_cache`.
+        """
+        self.pxml = pxml
+        self.info = dict(cached['info'])
+        for args in ('mandatory_args', 'non_mandatory_args', 'switches'):
+            self.info[args] = [AppArg(arg) for arg in self.info[args]]
+        self.command = cached['command']
+        self.shell = cached['shell']
+        self.location = cached['location']
+        self._unique_id = cached['unique_id']
+
+    def _parse_resources(self, resourceroot):
+        """Parse the optional resources block of plugin.xml:
+
+            <plugin_resources>
+                <cpus>8</cpus>
+                <memory>20G</memory>
+                <max_concurrent>2</max_concurrent>
+            </plugin_resources>
+
+        Each element is optional, see job_file.DEFAULT_RESOURCES.
+        """
+        if resourceroot is None:
+            return dict(DEFAULT_RESOURCES)
+        return parse_resources(dict((res.tag, (res.text or '').strip())
+                                    for res in resourceroot.iterchildren()))
+
     def _parse_args(self, argroot, isswitch=False):
         """Parse arument block of plugin.xml.
         """
@@ -251,7 +613,34 @@ class App(object):
 
         return args
 
+    def _compile_switches(self):
+        """Resolve the switch of the network, the scenario and every argument
+        and switch of the app once, so building a command line is a lookup
+        per option.
+        """
+        self._switches = dict()
+        for resource in ['network', 'scenario'] + \
+                [arg['name'] for arg in self.info['mandatory_args'] +
+                 self.info['non_mandatory_args'] + self.info['switches']]:
+            self._switches[resource] = self._match_switch(resource)
+
+        # Switches which are added to the command line if set to True
+        self._flags = dict()
+        for arg in self.info['switches']:
+            self._flags.setdefault(arg['name'], []).append(arg['switch'])
+
     def _get_switch(self, resource):
+        try:
+            return self._switches[resource]
+        except KeyError:
+            # Not declared by the app. Option names come from requests, so
+            # they are not memoised.
+            return self._match_switch(resource)
+
+    def _match_switch(self, resource):
+        """Find the switch of the argument which matches `resource` best. Of
+        equally good matches, the one declared first wins.
+        """
         if resource == 'network':
             keywords = ['net', ]
         elif resource == 'scenario':
@@ -259,27 +648,26 @@ class App(object):
         else:  # handle other options
             keywords = [resource]
 
-        matching_args = dict()
-
+        best_switch = None
+        best_score = 0.5
         for arg in self.info['mandatory_args'] + \
                 self.info['non_mandatory_args']:
+            name = arg['name'] or ''
             matchscore = 0
             for kw in keywords:
-                if kw in arg['name']:
+                if kw in name:
                     matchscore += 1
 
             # 'net_id' is better than 'net', 'id' is worse than 'net' --> 'id
             # gives half a point
-            if 'id' in arg['name']:
+            if 'id' in name:
                 matchscore += .5
-            matching_args[arg['switch']] = matchscore
 
-        sortidx = sorted([(v,i) for i, v in enumerate(matching_args.values())])
-        keyidx = sortidx[-1][1]
-        if sortidx[-1][0] > 0.5:
-            return matching_args.keys()[keyidx]
-        else:
-            return None
+            if matchscore > best_score:
+                best_switch = arg['switch']
+                best_score = matchscore
+
+        return best_switch
 
 
 class AppArg(dict):
@@ -318,9 +706,14 @@ class JobQueue(object):
     failed/
     logs/
     deleted/
+    staging/
+    archive/
     
-    Each job is a separate file containing the commandline to be executed. The
-    filename and the job ID are identical.
+    Each job is a separate file containing its manifest and the commandline
+    to be executed (see job_file.py). The filename and the job ID are
+    identical. Job files are written to staging/ and moved to queued/ once
+    complete. Completed jobs are eventually moved
+    into archive/ by the RetentionEngine (see retention.py).
     """
 
     def __init__(self, root):
@@ -341,7 +734,10 @@ class JobQueue(object):
                         'deleted'  : 'deleted',
                         'logs'     : 'logs',
                         'model'    : 'model',
-                        'uploads'  : 'uploads'
+                        'uploads'  : 'uploads',
+                        'cache'    : 'cache',
+                        'staging'  : 'staging',
+                        'archive'  : 'archive'
                         }
 
         # Create folder structure if necessary
@@ -354,77 +750,325 @@ class JobQueue(object):
         if 'win' in sys.platform:
             self.commentstr = 'rem'
         self.jobs = dict()
+        self.persist_output_state = False
+        self.index = JobIndex(self.root,
+                              [self.folders[f] for f in STATE_FOLDERS])
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.result_cache = None
+        self.journal = Journal(self.root)
+        self._journaled = None
+        # Threads reading job files when many of them are new, as on startup
+        self.scan_threads = 16
+        self._reset_indexes()
 
     def enqueue(self, app_id, job):
-        job.enqueued_at = datetime.now()
-        job.job_queue = self
-        self.jobs[job.id] = job
+        self.enqueue_many([job])
 
-        stderr = os.path.join(self.root, self.folders['logs'], "%s.log"%job.id)
-        stdout = os.path.join(self.root, self.folders['logs'], "%s.out"%job.id)
-        
-        #Better way to do this? 
-        job.logfile = stderr
-        job.outfile = stdout
-
-        with open(os.path.join(self.root, self.folders['queued'], job.file), 'w') \
-                as jobfile:
-            jobfile.write('\n'.join(["%s owner=%s"       % (self.commentstr,
-                                                           job.owner),
-                                     "%s app_id=%s"      % (self.commentstr,
-                                                           job.app_id),
-                                     "%s network_id=%s"  % (self.commentstr,
-                                                           job.network_id),
-                                     "%s network_name=%s"% (self.commentstr,
-                                                           job.network_name),
-                                     "%s scenario_id=%s" % (self.commentstr,
-                                                            job.scenario_id),
-                                     "%s scenario_name=%s"%(self.commentstr,
-                                                            job.scenario_name),
-                                     "%s created_at=%s"  % (self.commentstr,
-                                                           job.created_at),
-                                     "%s enqueued_at=%s" % (self.commentstr,
-                                                            job.enqueued_at),
-                                     "\n"]))
-            
-            cmd_with_outputs = job.command + ' 2> %s 1>%s' % (stderr, stdout)
-            jobfile.write(cmd_with_outputs)
-
-
-            jobfile.write('\n')
-
-            job.path = self.folders['queued']
+    def enqueue_many(self, jobs):
+        """Queue several jobs at once. All job files are written to staging/
+        first and only moved into queued/ once every one of them has been
+        written, so a runner never sees a partially written job. While they
+        are moved, a batch marker keeps runners from starting any of them
+        before all are in place (see job_batch.py).
 
+        With a result cache, jobs identical to one which finished earlier are
+        completed from the cache and go straight to finished/.
+        """
+        enqueued_at = datetime.now()
+        staging = os.path.join(self.root, self.folders['staging'])
+
+        staged = []
+        try:
+            for job in jobs:
+                job.enqueued_at = enqueued_at
+                job.job_queue = self
+
+                #Better way to do this? 
+                job.logfile = os.path.join(self.root, self.folders['logs'], "%s.log"%job.id)
+                job.outfile = os.path.join(self.root, self.folders['logs'], "%s.out"%job.id)
+
+                folder = self.folders['queued']
+                if self.result_cache is not None and job.app is not None \
+                        and job.app.info.get('cacheable'):
+                    job.result_key = self.result_cache.key(
+                        job.app.unique_id, job.command, job.input_files)
+                    entry = self.result_cache.restore(
+                        job.result_key, job.logfile, job.outfile,
+                        os.path.join(self.root, self.folders['model'], job.id))
+                    if entry is not None:
+                        log.info("Job %s reuses the results of job %s", job.id, entry['job_id'])
+                        job.cached_from = entry['job_id']
+                        folder = self.folders['finished']
+
+                with open(os.path.join(staging, job.file), 'w') as jobfile:
+                    jobfile.write(self._job_script(job))
+                staged.append((job, folder))
+        except Exception:
+            for job, folder in staged:
+                os.remove(os.path.join(staging, job.file))
+            raise
+
+        # Under the lock, so a refresh cannot find the job files before the
+        # jobs are indexed
+        queued = [job.file for job, folder in staged
+                  if folder == self.folders['queued']]
+        with self.lock, batch_marker(staging,
+                                     os.path.join(self.root, self.folders['queued']),
+                                     queued):
+            for job, folder in staged:
+                os.rename(os.path.join(staging, job.file),
+                          os.path.join(self.root, folder, job.file))
+                job.path = os.path.join(self.root, folder)
+                self.jobs[job.id] = job
+                self._index_job(job, folder)
+                self.index.move(job.file, folder)
+
+        self.journal.enqueued([(job.to_record(), folder) for job, folder in staged])
+
+        if any(folder == self.folders['queued'] for job, folder in staged):
+            notify(self.root)
+
+    def _job_script(self, job):
+        """The contents of the job file: the job's manifest followed by the
+        command, with its output redirected to the logs.
+        """
+        cmd_with_outputs = job.command + ' 2> %s 1>%s' % (job.logfile, job.outfile)
+
+        return format_job_file(job.to_manifest(), cmd_with_outputs, self.commentstr)
+
+    @timed('rebuild')
     def rebuild(self, app_registry):
-        """Rebuild job queue after server restart.
+        """Rebuild job queue after server restart. The jobs are restored
+        from the job journal where it has them, only the remaining job files
+        are read. Afterwards the journal is brought in line with the queue
+        folders.
         """
-        self.jobs = dict()
-        for folder in self.folders.values():
-            if folder in ('logs', 'uploads', 'deleted', 'model'):
+        started = datetime.now()
+        with self.lock:
+            self.jobs = dict()
+            self._reset_indexes()
+            self.index.reset()
+            self._journaled = self.journal.replay() or dict()
+            try:
+                self.refresh(app_registry)
+            finally:
+                journaled, self._journaled = self._journaled, None
+
+            unjournaled = [(job.to_record(), self._keys[jid][1])
+                           for jid, job in self.jobs.items()
+                           if jid not in journaled or
+                           journaled[jid]['folder'] != self._keys[jid][1]]
+            if unjournaled:
+                self.journal.enqueued(unjournaled, event='sync')
+            gone = [jid for jid in journaled if jid not in self.jobs]
+            if gone:
+                self.journal.removed(gone, event='sync')
+            self.journal.compact()
+
+        log.info("Restored %s jobs in %s, %s of them missing from the journal",
+                 len(self.jobs), datetime.now() - started, len(unjournaled))
+
+    def refresh(self, app_registry):
+        """Apply the changes made to the queue folders since the last refresh.
+        Only job files that are new to this process are read, jobs that moved
+        just have their path updated. Returns the changes as a list of (job,
+        old folder, new folder) tuples.
+        """
+        with self.lock:
+            moves = self.index.refresh()
+            loaded = self._read_jobs([os.path.join(self.root, new, jfile)
+                                      for jfile, old, new in moves
+                                      if new is not None and
+                                      jfile.split('.')[0] not in self.jobs])
+            # New jobs may be of apps another worker has just installed
+            apps = app_registry.sync() if loaded else None
+            changes = []
+            for jfile, old, new in moves:
+                jid = jfile.split('.')[0]
+                if new is None:
+                    job = self.jobs.pop(jid, None)
+                    if job is not None:
+                        self._unindex_job(job)
+                elif jid in self.jobs:
+                    job = self.jobs[jid]
+                    job.path = os.path.join(self.root, new)
+                    self._move_job(job, new)
+                else:
+                    job = self._add_job(loaded.get(os.path.join(self.root, new, jfile)),
+                                        os.path.join(self.root, new, jfile),
+                                        apps)
+                changes.append((job, old, new))
+                if new == self.folders['finished'] and old is not None:
+                    self._cache_result(job)
+            if changes:
+                for listener in self.listeners:
+                    listener(changes)
+            return changes
+
+    def _cache_result(self, job):
+        """Keep the results of a job which has just finished for identical
+        jobs queued later.
+        """
+        if self.result_cache is None or job is None or job.result_key is None:
+            return
+        self.result_cache.store(job.result_key, job.id, job.logfile, job.outfile,
+                                os.path.join(self.root, self.folders['model'], job.id))
+
+    def forget(self, job_id):
+        """Drop a job which is no longer in the queue folders.
+        """
+        with self.lock:
+            job = self.jobs.pop(job_id, None)
+            if job is not None:
+                self._unindex_job(job)
+
+    def query(self, owner=None, network_id=None, app_id=None, status=None,
+              since=None, until=None, cursor=None, limit=None):
+        """Return the jobs matching all given filters, most recently queued
+        first, and the cursor to pass to get the next page (None on the
+        last page). `status` may be a single status or a list of statuses;
+        `since` and `until` are datetimes bounding the time a job was queued.
+        """
+        filters = []
+        for index, values in ((self.by_owner, owner),
+                              (self.by_network, network_id),
+                              (self.by_app, app_id),
+                              (self.by_status, status)):
+            if values is None:
+                continue
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            filters.append((index, set(str(v) for v in values)))
+
+        # Walk the smallest of the matching groups, check the other filters
+        # for each job on it.
+        if filters:
+            filters.sort(key=lambda f: f[0].size(f[1]))
+            driver, values = filters.pop(0)
+            groups = [driver.get(value) for value in values]
+        else:
+            groups = self.by_status.groups.values()
+
+        before = decode_cursor(cursor) if cursor else None
+        if until is not None and (before is None or (until, '') < before):
+            before = (until, '')
+
+        jobs = []
+        for key in iter_descending(groups, before):
+            if since is not None and key[0] < since:
+                break
+            job = self.jobs.get(key[1])
+            if job is None:
                 continue
-            for jr, jf, jobfiles in os.walk(os.path.join(self.root, folder)):
-                for jfile in jobfiles:
-                    if not jfile.endswith('job'):
-                        continue
-                    exjob = Job()
-                    exjob.from_file(os.path.join(jr, jfile))
-                    exjob.app = app_registry.installed_apps.get(exjob.app_id)
-                    exjob.job_queue = self
-                    self.jobs[exjob.id] = exjob
-                    exjob.logfile = os.path.join(self.root, self.folders['logs'], "%s.log"%exjob.id)
-                    exjob.outfile = os.path.join(self.root, self.folders['logs'], "%s.out"%exjob.id)
-
-
-    def expunge_old_jobs(self):
-        """Delete finished job from list as it reaches a certain age.
-        Function for scheduled execution.
-        """
-        for key, job in self.jobs.iteritems():
-            if job.is_finished is True and \
-                    (datetime.now - job.enqueued_at).total_seconds() > 86400:
-                job.cleanup()
-                job.delete()
-                del self.jobs[key]
+            if all(self._value(index, job) in values
+                   for index, values in filters):
+                if limit is not None and len(jobs) == limit:
+                    return jobs, encode_cursor(sort_key(jobs[-1]))
+                jobs.append(job)
+        return jobs, None
+
+    def _value(self, index, job):
+        if index is self.by_status:
+            return self._keys[job.id][1]
+        elif index is self.by_owner:
+            return str(job.owner)
+        elif index is self.by_network:
+            return str(job.network_id)
+        return str(job.app_id)
+
+    def _reset_indexes(self):
+        self.sweeps = dict()
+        self.by_owner = SortedIndex()
+        self.by_network = SortedIndex()
+        self.by_app = SortedIndex()
+        self.by_status = SortedIndex()
+        # job id -> (sort key, folder)
+        self._keys = dict()
+
+    def _index_job(self, job, folder):
+        if job.id in self._keys:
+            # Indexed before, the job replaces what was indexed for it
+            self._unindex_job(job)
+        if job.sweep_id is not None:
+            self.sweeps.setdefault(job.sweep_id, set()).add(job.id)
+        key = sort_key(job)
+        self.by_owner.add(job.owner, key)
+        self.by_network.add(job.network_id, key)
+        self.by_app.add(job.app_id, key)
+        self.by_status.add(folder, key)
+        self._keys[job.id] = (key, folder)
+
+    def _move_job(self, job, folder):
+        key, old = self._keys[job.id]
+        if old != folder:
+            self.by_status.remove(old, key)
+            self.by_status.add(folder, key)
+            self._keys[job.id] = (key, folder)
+
+    def _unindex_job(self, job):
+        if job.sweep_id in self.sweeps:
+            self.sweeps[job.sweep_id].discard(job.id)
+            if not self.sweeps[job.sweep_id]:
+                del self.sweeps[job.sweep_id]
+        key, folder = self._keys.pop(job.id, (sort_key(job), None))
+        self.by_owner.remove(job.owner, key)
+        self.by_network.remove(job.network_id, key)
+        self.by_app.remove(job.app_id, key)
+        self.by_status.remove(folder, key)
+
+    def _read_jobs(self, paths):
+        """Read the jobs at `paths` and return a dict of path -> Job, or None
+        for job files which have gone. Jobs in the journal are restored from
+        it, the job files of the others are read by a pool of
+        `scan_threads` threads if there are many of them, so that on network
+        storage the round trips overlap.
+        """
+        loaded = dict()
+        unjournaled = []
+        for path in paths:
+            jid = os.path.basename(path).split('.')[0]
+            if self._journaled is not None and jid in self._journaled:
+                job = Job()
+                job.from_record(self._journaled[jid], os.path.dirname(path))
+                loaded[path] = job
+            else:
+                unjournaled.append(path)
+
+        if len(unjournaled) < 2 * self.scan_threads:
+            for path in unjournaled:
+                loaded[path] = _read_job_file(path)
+            return loaded
+
+        log.info("Reading %s job files with %s threads", len(unjournaled), self.scan_threads)
+        started = last_report = time.time()
+        pool = ThreadPool(self.scan_threads)
+        try:
+            for done, (path, job) in enumerate(pool.imap_unordered(
+                    _read_job_file_at, unjournaled, chunksize=16), 1):
+                loaded[path] = job
+                if time.time() - last_report > 5:
+                    last_report = time.time()
+                    log.info("Read %s of %s job files", done, len(unjournaled))
+        finally:
+            pool.terminate()
+        elapsed = time.time() - started
+        log.info("Read %s job files in %.1fs (%.0f files/s)", len(unjournaled), elapsed,
+                 len(unjournaled) / elapsed if elapsed else 0)
+        return loaded
+
+    def _add_job(self, exjob, path, apps):
+        if exjob is None:
+            # Moved on since the index saw it. The next refresh picks it up.
+            self.index.discard(os.path.basename(path))
+            return None
+        exjob.app = apps.get(exjob.app_id)
+        exjob.job_queue = self
+        self.jobs[exjob.id] = exjob
+        self._index_job(exjob, os.path.basename(os.path.dirname(path)))
+        exjob.logfile = os.path.join(self.root, self.folders['logs'], "%s.log"%exjob.id)
+        exjob.outfile = os.path.join(self.root, self.folders['logs'], "%s.out"%exjob.id)
+        return exjob
 
 
 class Job(object):
@@ -432,6 +1076,13 @@ class Job(object):
     belongs to one network and a user.
     """
 
+    # A queue holds a Job for every job file, keep them small
+    __slots__ = ('id', 'app', 'app_id', 'owner', 'network_id', 'network_name',
+                 'scenario_id', 'scenario_name', 'command', 'argv', 'file', 'path',
+                 'created_at', 'job_queue', 'enqueued_at', 'sweep_id',
+                 'priority', 'resources', 'input_files', 'result_key',
+                 'cached_from', 'logfile', 'outfile', '_markers', '_run_info')
+
     def __init__(self):
         self.id = None
         self.app = None
@@ -442,13 +1093,24 @@ class Job(object):
         self.scenario_id = None
         self.scenario_name = None
         self.command = None
+        self.argv = None
         self.file = None
         self.path = None
         self.created_at = None
         self.job_queue = None
         self.enqueued_at = None
-
-    def create(self, app, app_id, network_id, scenario_id, owner, options, network_name="", scenario_name=""):
+        self.sweep_id = None
+        self.priority = DEFAULT_PRIORITY
+        self.resources = dict(DEFAULT_RESOURCES)
+        self.input_files = ()
+        self.result_key = None
+        self.cached_from = None
+        self.logfile = None
+        self.outfile = None
+        self._markers = None
+        self._run_info = None
+
+    def create(self, app, app_id, network_id, scenario_id, owner, options, network_name="", scenario_name="", sweep_id=None, priority=None):
         self.id = str(uuid.uuid4())
         self.app = app
         self.app_id=app_id
@@ -457,7 +1119,13 @@ class Job(object):
         self.network_name = network_name
         self.scenario_id = scenario_id
         self.scenario_name = scenario_name
+        self.sweep_id = sweep_id
+        self.priority = parse_priority(priority)
+        self.resources = dict(app.info.get('resources', DEFAULT_RESOURCES))
+        self.input_files = [val for val in options.values()
+                            if isinstance(val, basestring) and os.path.isfile(val)]
         self.command = app.cli_command(app_id, network_id, scenario_id, options)
+        self.argv = app.cli_args(app_id, network_id, scenario_id, options)
         self.file = '.'.join([self.id, 'job'])
         self.created_at = datetime.now()
 
@@ -473,6 +1141,9 @@ class Job(object):
 
         log.info("Moving job %s from %s to deleted folder %s", jobfile, fullpath, delpath)
         os.rename(fullpath, os.path.join(delpath, jobfile))
+        if self.job_queue is not None:
+            self.job_queue.index.discard(self.file)
+            self.job_queue.journal.moved(self.id, 'deleted')
 
     def restart(self):
         """
@@ -486,6 +1157,60 @@ class Job(object):
 
         log.info("Moving job %s to queued folder", jobfile)
         os.rename(fullpath, os.path.join(delpath, jobfile))
+        self.path = os.path.normpath(delpath)
+        self._markers = None
+        if self.outfile is not None and os.path.exists(self.outfile + '.state'):
+            os.remove(self.outfile + '.state')
+        self._run_info = None
+        if self.job_queue is not None and os.path.exists(self._run_info_path()):
+            os.remove(self._run_info_path())
+        if self.job_queue is not None:
+            self.job_queue.index.move(self.file, 'queued')
+            self.job_queue.journal.moved(self.id, 'queued')
+            notify(self.job_queue.root)
+
+    def to_record(self):
+        """The metadata of the job, as kept in the job journal.
+        """
+        return dict(id=self.id, owner=self.owner, app_id=self.app_id,
+                    network_id=self.network_id, network_name=self.network_name,
+                    scenario_id=self.scenario_id,
+                    scenario_name=self.scenario_name,
+                    created_at=str(self.created_at),
+                    enqueued_at=str(self.enqueued_at),
+                    sweep_id=self.sweep_id, priority=self.priority,
+                    resources=self.resources, result_key=self.result_key,
+                    cached_from=self.cached_from, command=self.command)
+
+    def to_manifest(self):
+        """The manifest written into the job file, see job_file.py.
+        """
+        manifest = self.to_record()
+        manifest.update(version=MANIFEST_VERSION, argv=self.argv,
+                        input_files=list(self.input_files))
+        return manifest
+
+    def from_record(self, record, path):
+        """Reconstruct Job object from a job journal record, for the job
+        file in the folder `path`.
+        """
+        self.id = record['id']
+        self.file = '.'.join([self.id, 'job'])
+        self.path = path
+        self.owner = record['owner']
+        self.app_id = record['app_id']
+        self.network_id = record['network_id']
+        self.network_name = record['network_name']
+        self.scenario_id = record['scenario_id']
+        self.scenario_name = record['scenario_name']
+        self.created_at = parse_timestamp(record['created_at'])
+        self.enqueued_at = parse_timestamp(record['enqueued_at'])
+        self.sweep_id = record['sweep_id']
+        self.priority = record['priority']
+        self.resources = record['resources']
+        self.result_key = record['result_key']
+        self.cached_from = record['cached_from']
+        self.command = record['command']
 
     def from_file(self, jobfile):
         """
@@ -495,62 +1220,101 @@ class Job(object):
         self.file = os.path.basename(jobfile)
         self.path = os.path.dirname(jobfile)
         self.id = self.file.split('.')[0]
-        with open(jobfile, 'r') as jf:
-            jobdata = jf.read()
-        
-        jobdata = jobdata.split('\n')
-        for line in jobdata:
-            if line.startswith('#') or line.startswith('rem'):
-                if 'owner' in line:
-                    self.owner = line.split('=')[-1]
-                elif 'app_id' in line:
-                    self.app_id = line.split('=')[-1]
-                elif 'network_id' in line:
-                    self.network_id = int(line.split('=')[-1])
-                elif 'scenario_id' in line:
-                    self.scenario_id = int(line.split('=')[-1])
-                elif 'scenario_name' in line:
-                    self.scenario_name = line.split('=')[-1]
-                elif 'network_name' in line:
-                    self.network_name = line.split('=')[-1]
-                elif 'created_at' in line:
-                    self.created_at = date_parser.parse(line.split('=')[-1])
-                elif 'enqueued_at' in line:
-                    self.enqueued_at = date_parser.parse(line.split('=')[-1])
-            elif len(line) > 0:
-                self.command = line
+
+        manifest = read_manifest(jobfile)
+        self.owner = manifest['owner']
+        self.app_id = manifest['app_id']
+        self.network_id = manifest['network_id']
+        self.network_name = manifest['network_name']
+        self.scenario_id = manifest['scenario_id']
+        self.scenario_name = manifest['scenario_name']
+        self.created_at = _header_timestamp(manifest['created_at'])
+        self.enqueued_at = _header_timestamp(manifest['enqueued_at'])
+        self.sweep_id = manifest['sweep_id']
+        self.result_key = manifest['result_key']
+        self.cached_from = manifest['cached_from']
+        self.priority = manifest['priority']
+        self.resources = manifest['resources']
+        self.command = manifest['command']
+        self.argv = manifest['argv']
+        self.input_files = manifest.get('input_files') or ()
 
     def get_details(self):
         """
             Get logs, output text and progress of the job
         """
         logs = self.get_logs()
-        output = self.get_output()
-        progress = self.get_progress()
+        markers = self.markers()
 
-        return {'progress':progress, 'output':output, 'logs':logs}
+        return {'progress':markers.progress or (0, None), 'output':list(markers.output), 'logs':logs, 'run':self.run_info()}
+
+    def _run_info_path(self):
+        return os.path.join(self.job_queue.root, self.job_queue.folders['logs'], self.id + RUN_INFO_SUFFIX)
+
+    def run_info(self, status=None):
+        """
+            When the job was claimed, started and ended, its exit code and
+            resource usage, as far as the queue runner has recorded them (see
+            run_info.py). Read once the job has ended, queued jobs have none.
+        """
+        if self._run_info is not None:
+            return self._run_info
+        status = status or self.status
+        if status == 'queued' or self.job_queue is None:
+            return {}
+        info = read_run_info(self._run_info_path())
+        if 'ended_at' in info or status in ('finished', 'failed'):
+            self._run_info = info
+        return info
 
     def get_logs(self, limit=100):
         """
-            Get the log output. Limit to 100 lines to save time.
+            Get the log output. Limit to the last 100 lines to save time.
         """
+        if limit is not None:
+            return tail_lines(self.logfile, limit)[0]
         with open(self.logfile, 'r') as f:
-            if limit is not None:
-                return f.readlines()[0:limit]
-            else:
-                return f.readlines()
+            return f.readlines()
+
+    def tail(self, log_offset=None, out_offset=0, limit=100):
+        """
+            Get what was added to the log and output of the job since the
+            given byte offsets. Without a log offset, the last `limit` lines of
+            the log are returned. The offsets to pass next time are part of
+            the result.
+        """
+        if log_offset is None:
+            logs, log_offset = tail_lines(self.logfile, limit)
+            # As below, the next call starts with the incomplete last line
+            if logs and not logs[-1].endswith('\n') and \
+                    len(logs[-1]) < READ_SIZE:
+                log_offset -= len(logs.pop())
+        else:
+            data, log_offset = read_from(self.logfile, log_offset)
+            # Hold back an incomplete last line until it is finished, unless
+            # it fills a whole read and would never be returned
+            if not data.endswith('\n') and \
+                    ('\n' in data or len(data) < READ_SIZE):
+                partial = data[data.rfind('\n') + 1:]
+                data = data[:-len(partial)]
+                log_offset -= len(partial)
+            logs = data.splitlines(True)
+
+        output, progress, out_offset = scan_markers(self.outfile, out_offset)
+        if progress is None:
+            # Nothing new reported, the latest progress still holds
+            progress = self.markers().progress
+
+        return {'logs': logs, 'output': output, 'progress': progress,
+                'log_offset': log_offset, 'out_offset': out_offset}
 
     def get_native_logs(self):
         """
             If the job has run a program which produces its own native log
-            retrieve it here. Returns a file. A file containing
-            "EXCLUDE_START" and "EXCLUDE_END" will exclude everything between these
-            two tags. This is in case the log file contains sensitive information which
-            can be controlled by the model (by placing the tags into the log)
+            retrieve it here. Returns a CachedArtifact holding the filtered
+            log (see app_utilities.filter_native_log), or a message if there
+            is no log.
         """
-        all_lines = []
-        ignoring = False
-
         if self.app is None:
             return "App for job cannot be found. Has it been removed?"
         
@@ -570,41 +1334,16 @@ class Job(object):
 
         nativelogfile=files[0]
 
-        with open(nativelogfile, 'r') as f:
-            prev_line = ""
-            for l in f.readlines():
-                if l.find('EXCLUDE_START') >= 0:
-                    ignoring = True
-                    continue
-                elif l.find('EXCLUDE_END') >= 0:
-                    ignoring=False
-                    continue
-
-                #If an error is spotted, ouput that line and the one previous, regardless of
-                #whether we're in ignore mode
-                if l.find(error_flag) >= 0:
-                    #Don't double-add if there's two lines like this in a row
-                    if prev_line.find(error_flag) == -1:
-                        all_lines.append(prev_line)
-                    all_lines.append(l)
-                elif ignoring is False:
-                    all_lines.append(l)
-
-
-                prev_line = l
-
-        nativefilename = nativelogfile.split(os.sep)[-1]
-        
-        log.info("%s Lines", len(all_lines))
-        with open(tempfile.gettempdir() + os.sep + nativefilename, 'w') as f:
-            f.write("".join(all_lines))
-            log.info("Return file at: %s", f.name)
-            return f
+        cache_dir = os.path.join(self.job_queue.root, self.job_queue.folders['cache'], 'nativelogs')
+
+        return CachedArtifact(nativelogfile, cache_dir, self.id,
+                              lambda lines: filter_native_log(lines, error_flag))
 
     def get_native_output(self):
         """
-            If the job has run a program which produces its own native log
-            retrieve it here. Returns a file.
+            If the job has run a program which produces its own native output
+            retrieve it here. Returns a CachedArtifact holding the gzipped
+            output file, its `source` is the output file itself.
         """
 
         if self.app is None:
@@ -619,37 +1358,34 @@ class Job(object):
 
         files.sort(key=lambda x: os.path.getmtime(x))
 
-        f =  open(files[-1], 'r')
-        log.info("Return file at: %s", f.name)
-        return f
+        log.info("Return file at: %s", files[-1])
+        cache_dir = os.path.join(self.job_queue.root, self.job_queue.folders['cache'], 'nativeoutputs')
+        return CachedArtifact(files[-1], cache_dir, self.id, gzip_file, suffix='.gz')
+
+    def markers(self):
+        """
+            The output and progress reported by the job so far, parsed
+            incrementally.
+        """
+        if self._markers is None or self._markers.path != self.outfile:
+            persist = self.job_queue is not None and \
+                    self.job_queue.persist_output_state
+            self._markers = MarkerState(self.outfile, persist=persist)
+        return self._markers.update()
 
     def get_output(self):
-        output = []
-        with open(self.outfile, 'r') as f:
-            for line in f.readlines():
-                line = line.strip()
-                if line.startswith("!!Output"):
-                    line = line.replace('!!Output ', '')
-                    output.append(line)
-        return  output
+        return list(self.markers().output)
 
     def get_progress(self):
-        progress=0
-        total = None
-        with open(self.outfile, 'r') as f:
-            for line in f.readlines():
-                line = line.strip()
-                if line.startswith("!!Progress"):
-                    line = line.replace('!!Progress', '')
-                    line = line.split('/')
-                    if len(line) == 2:
-                        progress = int(line[0])
-                        if total == None:
-                            total = int(line[1])
-        return  progress, total
+        return self.markers().progress or (0, None)
 
     @property
     def status(self):
+        if self.job_queue is not None:
+            status = self.job_queue.index.state(self.file)
+            if status is not None:
+                return status
+
         jobfilepath = glob.glob(self.job_queue.root + os.sep + '*' + os.sep +
                                 self.file)[0]
         status = jobfilepath.replace(self.job_queue.root + os.sep, '')
@@ -681,27 +1417,85 @@ class Job(object):
         return self.status == 'failed'
 
 
-def scan_installed_apps(plugin_path):
+def _read_job_file(path):
+    """Read the job file at `path`, or return None if it has gone.
+    """
+    job = Job()
+    try:
+        job.from_file(path)
+    except IOError:
+        return None
+    return job
+
+
+def _read_job_file_at(path):
+    return path, _read_job_file(path)
+
+
+def _header_timestamp(value):
+    try:
+        return parse_timestamp(value)
+    except ValueError:
+        # Written by hand or by an older version
+        return date_parser.parse(value)
+
+
+@timed('scan_installed_apps')
+def scan_installed_apps(plugin_path, cache=None):
     """Scan installed Apps and retrieve necessary information. Returns a
     dictionary indexed by a hash of the 'plugin.xml' file to guarantee
     persistency after server restart and allow for the installation of
     different versions of the same App.
+
+    With a RegistryCache, only 'plugin.xml' files which are not in the cache
+    or have changed since are parsed.
     """
 
     log.info("Scanning installed apps in %s", plugin_path)
+    plugin_files = find_plugin_files(plugin_path)
+    installed_apps = load_apps(plugin_files, cache=cache)
+
+    if cache is not None:
+        cache.prune(set(plugin_files))
+        cache.save()
+
+    return installed_apps
+
+
+def find_plugin_files(plugin_path):
     plugin_files = []
     for proot, pfolders, pfiles in os.walk(plugin_path, followlinks=True):
+        # Packages being installed are not installed yet
+        if INSTALLS_FOLDER in pfolders:
+            pfolders.remove(INSTALLS_FOLDER)
         for item in pfiles:
             if item == 'plugin.xml':
                 plugin_files.append(os.path.join(proot, item))
+    return plugin_files
+
 
+def load_apps(plugin_files, cache=None):
+    """Load the apps defined in `plugin_files`, parsing only those which are
+    not in the RegistryCache `cache` or have changed since.
+    """
     installed_apps = dict()
+    parsed = 0
     for pxml in plugin_files:
-        app = App(pxml=pxml)
+        if cache is None:
+            app = App(pxml=pxml)
+        else:
+            stat = os.stat(pxml)
+            cached = cache.get(pxml, stat)
+            if cached is not None:
+                app = App(pxml=pxml, cached=cached)
+            else:
+                app = App(pxml=pxml)
+                cache.put(pxml, stat, app._to_cache())
+                parsed += 1
         appkey = app.unique_id
         installed_apps[appkey] = app
-    
-    log.info("%s installed apps found", len(installed_apps))
+
+    log.info("%s installed apps found, %s parsed", len(installed_apps), parsed)
 
     return installed_apps
 
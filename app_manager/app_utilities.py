@@ -53,10 +53,8 @@ def get_progress_from_output(output):
     progress=0
     total=100
     status='Pending'
-    output =strip_output_lines(output)
-    for i in range( 0, len(output)):
-
-        line = (output[len(output)-1-i])
+    for line in reversed(output):
+        line = line.strip()
         if line.startswith("!!Progress"):
             line = line.replace('!!Progress', '')
             line = line.split('/')
@@ -66,3 +64,31 @@ def get_progress_from_output(output):
                 status='Running'
                 break
     return  status, progress, total
+
+
+def filter_native_log(lines, error_flag='**** '):
+    """Filter the lines of a model's native log. Everything between lines
+    containing "EXCLUDE_START" and "EXCLUDE_END" is left out, in case the log
+    contains sensitive information which can be controlled by the model.
+    Lines containing `error_flag` are kept regardless, together with the line
+    before them.
+    """
+    ignoring = False
+    prev_line = ""
+    for l in lines:
+        if l.find('EXCLUDE_START') >= 0:
+            ignoring = True
+            continue
+        elif l.find('EXCLUDE_END') >= 0:
+            ignoring = False
+            continue
+
+        if l.find(error_flag) >= 0:
+            #Don't double-add if there's two lines like this in a row
+            if prev_line.find(error_flag) == -1:
+                yield prev_line
+            yield l
+        elif ignoring is False:
+            yield l
+
+        prev_line = l
@@ -0,0 +1,103 @@
+"""Cache files derived from job files, e.g. filtered native logs or
+compressed native outputs.
+"""
+import os
+import zlib
+import uuid
+import glob
+import logging
+
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+def file_chunks(f, size=CHUNK_SIZE):
+    return iter(lambda: f.read(size), '')
+
+
+def gzip_chunks(chunks):
+    """Compress a stream of chunks into a gzip stream.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def gzip_file(f):
+    """Transform for a CachedArtifact holding the gzipped source.
+    """
+    return gzip_chunks(file_chunks(f))
+
+
+class CachedArtifact(object):
+    """A file derived from `source` by `transform`, a generator function
+    taking the open source file and yielding the derived file in pieces. The
+    result is cached in `cache_dir` under a name made from `key`, the mtime
+    and the size of the source, so it is only derived again once the source
+    has changed.
+    """
+
+    def __init__(self, source, cache_dir, key, transform, suffix=''):
+        self.source = source
+        self.cache_dir = cache_dir
+        self.key = key
+        self.transform = transform
+        self.suffix = suffix
+        self.filename = os.path.basename(source)
+
+        stat = os.stat(source)
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        self.path = os.path.join(cache_dir, '%s-%d-%d-%s%s' % (
+            key, int(stat.st_mtime), stat.st_size, self.filename, suffix))
+
+    @property
+    def is_cached(self):
+        return os.path.isfile(self.path)
+
+    def generate(self):
+        """Yield the derived file in chunks, writing it to the cache on the
+        way. The cache entry only appears once the whole file was written,
+        concurrent requests each write their own temporary file.
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmppath = '%s.%s.tmp' % (self.path, uuid.uuid4().hex)
+
+        complete = False
+        try:
+            with open(self.source, 'rb') as src, open(tmppath, 'wb') as dst:
+                buf = []
+                size = 0
+                for line in self.transform(src):
+                    buf.append(line)
+                    size += len(line)
+                    if size >= CHUNK_SIZE:
+                        chunk = ''.join(buf)
+                        dst.write(chunk)
+                        yield chunk
+                        buf = []
+                        size = 0
+                chunk = ''.join(buf)
+                dst.write(chunk)
+                yield chunk
+            complete = True
+        finally:
+            if complete:
+                self._evict_stale()
+                os.rename(tmppath, self.path)
+            elif os.path.exists(tmppath):
+                os.remove(tmppath)
+
+    def _evict_stale(self):
+        """Remove the cache entries of earlier versions of the source.
+        """
+        for stale in glob.glob(os.path.join(self.cache_dir, '%s-*-%s%s' % (
+                self.key, self.filename, self.suffix))):
+            if stale != self.path:
+                os.remove(stale)
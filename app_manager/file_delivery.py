@@ -0,0 +1,119 @@
+"""Deliver large job files (native logs and outputs) to the browser without
+holding them in memory.
+
+Files on disk are sent with an ETag made from their size and mtime, answer
+conditional requests with 304 and single byte ranges with 206, so resumed
+and repeated downloads are cheap.
+"""
+import os
+import logging
+
+from flask import Response, request, stream_with_context
+from werkzeug.http import http_date
+
+from artifact_cache import CHUNK_SIZE, gzip_chunks
+
+
+log = logging.getLogger(__name__)
+
+# Extensions of native outputs which are worth compressing for transfer
+COMPRESSIBLE_EXTENSIONS = ('csv', 'txt', 'log', 'lst', 'out', 'gms', 'dat',
+                           'inc', 'json', 'xml')
+
+
+def accepts_gzip():
+    return 'gzip' in request.headers.get('Accept-Encoding', '')
+
+
+def is_compressible(filename):
+    return filename.rsplit('.', 1)[-1].lower() in COMPRESSIBLE_EXTENSIONS
+
+
+def send_stream(chunks, filename, compress=False):
+    """Send a generated file as a chunked attachment, gzip-encoded on the fly
+    if `compress` is set.
+    """
+    headers = {'Content-Disposition': 'attachment; filename="%s"' % filename}
+    if compress:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+
+    return Response(stream_with_context(chunks),
+                    mimetype='application/octet-stream',
+                    headers=headers)
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _etag(size, mtime, variant=''):
+    return '"%x-%x%s"' % (size, int(mtime * 1000), variant)
+
+
+def send_conditional(path, filename, gzipped=None):
+    """Send the file at `path` as an attachment named `filename`, honouring
+    If-None-Match, If-Range and Range headers.
+
+    `gzipped` is an optional CachedArtifact holding the gzipped file. It is
+    used for whole-file requests from clients accepting gzip: from the cache
+    if it is there, otherwise compressed on the fly while filling the cache.
+    """
+    stat = os.stat(path)
+    etag = _etag(stat.st_size, stat.st_mtime)
+
+    headers = {'Content-Disposition': 'attachment; filename="%s"' % filename,
+               'Accept-Ranges': 'bytes',
+               'Last-Modified': http_date(stat.st_mtime)}
+    if gzipped is not None:
+        headers['Vary'] = 'Accept-Encoding'
+
+    use_gzip = gzipped is not None and 'Range' not in request.headers \
+            and accepts_gzip()
+    if use_gzip:
+        etag = _etag(stat.st_size, stat.st_mtime, '-gz')
+    headers['ETag'] = etag
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None and \
+            (if_none_match.strip() == '*' or
+             etag in [t.strip() for t in if_none_match.split(',')]):
+        return Response(status=304, headers=headers)
+
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+        if gzipped.is_cached:
+            headers['Content-Length'] = str(os.path.getsize(gzipped.path))
+            chunks = _read_range(gzipped.path, 0, os.path.getsize(gzipped.path))
+        else:
+            chunks = gzipped.generate()
+        return Response(stream_with_context(chunks),
+                        mimetype='application/octet-stream', headers=headers)
+
+    byte_range = request.range
+    if_range = request.headers.get('If-Range')
+    # Multiple ranges are rare enough to simply send the whole file
+    if byte_range is not None and len(byte_range.ranges) == 1 and \
+            (if_range is None or if_range == etag):
+        bounds = byte_range.range_for_length(stat.st_size)
+        if bounds is None:
+            headers['Content-Range'] = 'bytes */%d' % stat.st_size
+            return Response(status=416, headers=headers)
+        start, stop = bounds
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1,
+                                                       stat.st_size)
+        headers['Content-Length'] = str(stop - start)
+        return Response(_read_range(path, start, stop - start), status=206,
+                        mimetype='application/octet-stream', headers=headers)
+
+    headers['Content-Length'] = str(stat.st_size)
+    return Response(_read_range(path, 0, stat.st_size),
+                    mimetype='application/octet-stream', headers=headers)
@@ -0,0 +1,70 @@
+"""Let a batch of jobs appear in queued/ at once.
+
+Job files are moved into queued/ one rename at a time. While a batch is being
+moved, a marker file in queued/ lists its job files:
+
+    queued/.batch-<batch id>    {"jobs": ["<job id>.job", ...]}
+
+Runners pass over the jobs of a marker until it is removed, which happens
+once the whole batch is in place. A marker left behind by a crash is removed
+by the next runner to see it once it is older than BATCH_TIMEOUT seconds.
+"""
+import os
+import json
+import time
+import uuid
+import logging
+
+from contextlib import contextmanager
+
+
+log = logging.getLogger(__name__)
+
+BATCH_PREFIX = '.batch-'
+BATCH_TIMEOUT = 300
+
+
+@contextmanager
+def batch_marker(staging, folder, jobfiles):
+    """Hide `jobfiles` in `folder` from runners for as long as the context
+    lasts. The marker is written to `staging` and renamed into `folder`, so
+    runners never read a partial one. A single job needs no marker.
+    """
+    if len(jobfiles) < 2:
+        yield
+        return
+
+    name = BATCH_PREFIX + uuid.uuid4().hex
+    tmppath = os.path.join(staging, name)
+    with open(tmppath, 'w') as f:
+        json.dump(dict(jobs=list(jobfiles)), f)
+    path = os.path.join(folder, name)
+    os.rename(tmppath, path)
+    try:
+        yield
+    finally:
+        os.remove(path)
+
+
+def pending_jobs(folder, names):
+    """The job files of batches which are still being moved into `folder`,
+    given `names`, the listing of the folder.
+    """
+    pending = set()
+    for name in names:
+        if not name.startswith(BATCH_PREFIX):
+            continue
+        path = os.path.join(folder, name)
+        try:
+            if time.time() - os.path.getmtime(path) > BATCH_TIMEOUT:
+                log.warning("Removing batch marker %s left behind.", name)
+                os.remove(path)
+                continue
+            with open(path, 'r') as f:
+                pending.update(json.load(f)['jobs'])
+        except (IOError, OSError):
+            # Removed in the meantime, the batch is complete
+            continue
+        except (ValueError, KeyError):
+            log.warning("Ignoring unreadable batch marker %s", name)
+    return pending
@@ -0,0 +1,87 @@
+import time
+import select
+import logging
+import threading
+import collections
+
+
+log = logging.getLogger(__name__)
+
+
+class JobEventFeed(object):
+    """Fan out job queue changes to all status streams of a web worker.
+
+    A single background thread calls `poll` and numbers the events it
+    returns. Streams block on a condition until there is something newer than
+    the last event they have seen, so an idle stream costs nothing however
+    many of them are open. Every `heartbeat` seconds all streams are woken up
+    even without news, which lets them notice disconnected clients.
+    """
+
+    def __init__(self, poll, fileno=None, interval=1, heartbeat=15,
+                 backlog=1000):
+        self.poll = poll
+        self.fileno = fileno
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.events = collections.deque(maxlen=backlog)
+        self.seq = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start the feed thread. This is done lazily, so it happens after a
+        pre-forking server has forked its workers.
+        """
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='job-events')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        last_beat = time.time()
+        while True:
+            try:
+                events = self.poll()
+            except Exception:
+                log.exception("Error polling the job queue.")
+                events = []
+
+            now = time.time()
+            beat = now - last_beat >= self.heartbeat
+            if events or beat:
+                with self._cond:
+                    for event in events:
+                        self.seq += 1
+                        self.events.append((self.seq, event))
+                    self._cond.notify_all()
+            if beat:
+                last_beat = now
+
+            self._sleep()
+
+    def _sleep(self):
+        """Wait for the next poll, returning early on inotify events.
+        """
+        fd = self.fileno() if self.fileno is not None else None
+        if fd is None:
+            time.sleep(self.interval)
+            return
+        try:
+            select.select([fd], [], [], self.interval)
+        except select.error:
+            time.sleep(self.interval)
+
+    def wait(self, after):
+        """Block until there are events with a sequence number greater than
+        `after` or the next heartbeat. Returns the list of (seq, event) pairs
+        and the sequence number to wait after next time.
+        """
+        self.start()
+        with self._cond:
+            if self.seq <= after:
+                self._cond.wait()
+            return [(s, e) for s, e in self.events if s > after], self.seq
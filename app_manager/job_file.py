@@ -0,0 +1,168 @@
+"""The job file format shared by the web application and the queue runner.
+
+A job file is a shell script. The job's metadata is held in a manifest, a
+JSON object on a comment line at the top of the file, followed by the
+command to run:
+
+    # manifest={"argv":["bash","/apps/x/run.sh","-t","3"],"id":"...",...}
+
+    bash /apps/x/run.sh -t 3 2> logs/<job id>.log 1>logs/<job id>.out
+
+The manifest holds everything Job.to_manifest writes, including the command
+line as a list of arguments, which the queue runner executes without a
+shell. Job files written before manifests hold their metadata in comment
+lines of the form
+
+    # key=value
+
+instead; `read_manifest` turns these into a manifest as well.
+"""
+import re
+import json
+import math
+
+from datetime import datetime
+
+COMMENT_PREFIXES = ('#', 'rem')
+
+MANIFEST_KEY = 'manifest'
+MANIFEST_VERSION = 1
+
+# Metadata of legacy job files which is kept as written
+LEGACY_FIELDS = ('owner', 'app_id', 'network_name', 'scenario_name',
+                 'created_at', 'enqueued_at', 'sweep_id', 'result_key',
+                 'cached_from')
+
+# Priority levels of jobs. Within the jobs of one owner, a level gets twice
+# as many turns as the level below it.
+PRIORITIES = {'low': 0, 'normal': 1, 'high': 2}
+DEFAULT_PRIORITY = PRIORITIES['normal']
+
+
+def parse_priority(value):
+    """Turn a priority given by name or number into a priority level.
+    """
+    if value is None or value == '':
+        return DEFAULT_PRIORITY
+    if isinstance(value, basestring) and value.lower() in PRIORITIES:
+        return PRIORITIES[value.lower()]
+    priority = int(value)
+    return max(min(priority, max(PRIORITIES.values())), min(PRIORITIES.values()))
+
+
+def priority_weight(priority):
+    return 2 ** priority
+
+
+# The resources a job needs if its app does not declare any. Memory is in MB,
+# 0 leaves the job's memory out of the accounting. A max_concurrent of None
+# does not limit the number of jobs of an app running at the same time.
+DEFAULT_RESOURCES = {'cpus': 1, 'memory': 0, 'max_concurrent': None}
+
+MEMORY_UNITS = {'': 1, 'k': 1 / 1024., 'm': 1, 'g': 1024, 't': 1024 ** 2}
+
+
+def parse_memory(value):
+    """Turn an amount of memory such as '512M', '20G' or '2048' (MB) into MB.
+    """
+    match = re.match(r'^\s*([0-9.]+)\s*([kmgt]?)i?b?\s*$', str(value).lower())
+    if match is None:
+        raise ValueError("Cannot read amount of memory %r" % (value,))
+    return int(math.ceil(float(match.group(1)) * MEMORY_UNITS[match.group(2)]))
+
+
+def parse_resources(values):
+    """Read the resources a job needs from a dict of strings, like a job file
+    header or the resources block of a plugin.xml. Missing values are taken
+    from DEFAULT_RESOURCES.
+    """
+    resources = dict(DEFAULT_RESOURCES)
+    if values.get('cpus'):
+        resources['cpus'] = max(int(values['cpus']), 1)
+    if values.get('memory'):
+        resources['memory'] = parse_memory(values['memory'])
+    if values.get('max_concurrent'):
+        resources['max_concurrent'] = max(int(values['max_concurrent']), 1)
+    return resources
+
+
+def parse_timestamp(value):
+    """Parse a timestamp as written by str(datetime), with or without
+    microseconds, or return None for an empty value.
+    """
+    if not value or value == 'None':
+        return None
+    # Sliced by hand, strptime is about ten times slower
+    if len(value) not in (19, 26) or value[4] != '-' or value[10] != ' ':
+        raise ValueError("Cannot read timestamp %r" % (value,))
+    return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                    int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                    int(value[20:26] or 0))
+
+
+def read_job_file(path):
+    """Read the metadata and the command of a job file. Reading stops at the
+    command, so whatever follows it is never read.
+    """
+    header = dict()
+    command = None
+    with open(path, 'r') as jf:
+        for line in jf:
+            line = line.strip()
+            if not line:
+                continue
+            for prefix in COMMENT_PREFIXES:
+                if line.startswith(prefix):
+                    line = line[len(prefix):]
+                    break
+            else:
+                command = line
+                break
+            if '=' in line:
+                key, value = line.split('=', 1)
+                header[key.strip()] = value
+    return header, command
+
+
+def read_manifest(path):
+    """Read the manifest of a job file, converting the header of a legacy
+    job file into one.
+    """
+    header, command = read_job_file(path)
+    if MANIFEST_KEY in header:
+        return json.loads(header[MANIFEST_KEY])
+    return legacy_manifest(header, command)
+
+
+def legacy_manifest(header, command):
+    """The manifest of a legacy job file with the `header` and `command`.
+    Such files have no argv, and their command includes the redirection of
+    the job's output. An unreadable priority or resources are replaced by
+    the defaults.
+    """
+    manifest = dict((field, header.get(field)) for field in LEGACY_FIELDS)
+    manifest.update(version=0, argv=None, command=command,
+                    network_id=_legacy_int(header.get('network_id')),
+                    scenario_id=_legacy_int(header.get('scenario_id')))
+    try:
+        manifest['priority'] = parse_priority(header.get('priority'))
+    except ValueError:
+        manifest['priority'] = DEFAULT_PRIORITY
+    try:
+        manifest['resources'] = parse_resources(header)
+    except ValueError:
+        manifest['resources'] = dict(DEFAULT_RESOURCES)
+    return manifest
+
+
+def _legacy_int(value):
+    return int(value) if value not in (None, '', 'None') else None
+
+
+def format_job_file(manifest, command, comment='#'):
+    """The contents of a job file with the `manifest` and running `command`.
+    """
+    return '%s %s=%s\n\n%s\n' % (comment, MANIFEST_KEY,
+                                  json.dumps(manifest, sort_keys=True,
+                                             separators=(',', ':')),
+                                  command)
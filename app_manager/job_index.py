@@ -0,0 +1,211 @@
+import os
+import time
+import logging
+import threading
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+log = logging.getLogger(__name__)
+
+# The folders a job file can live in. The folder a job file is in *is* the
+# status of the job.
+STATE_FOLDERS = ('queued', 'tmp', 'running', 'finished', 'failed')
+
+JOB_SUFFIX = '.job'
+
+
+def list_job_files(path):
+    """The names of the job files in the folder `path`. With scandir, the
+    file type comes with the listing, so no stat call per file is needed to
+    leave out anything else.
+    """
+    if scandir is None:
+        return [f for f in os.listdir(path) if f.endswith(JOB_SUFFIX)]
+    return [entry.name for entry in scandir(path)
+            if entry.name.endswith(JOB_SUFFIX) and entry.is_file()]
+
+
+class JobIndex(object):
+    """An in-memory map of job file name -> queue folder.
+
+    The index follows inotify events on the state folders where pyinotify is
+    available. In addition, the mtime of each state folder is checked on
+    refresh and a folder is only listed again if it has changed, so the index
+    also converges on filesystems without inotify support (NFS, ...). Every
+    `reconcile_interval` seconds all folders are listed regardless.
+    """
+
+    def __init__(self, root, folders=STATE_FOLDERS, reconcile_interval=60):
+        self.root = root
+        self.folders = tuple(folders)
+        self.reconcile_interval = reconcile_interval
+        self.states = dict()
+        self._changes = dict()
+        self._lock = threading.RLock()
+        self._scanned = dict()
+        self._last_reconcile = 0
+        self._events = []
+        self._watch_manager = None
+        self._notifier = None
+        self._start_watching()
+
+    def _start_watching(self):
+        if pyinotify is None:
+            log.info("pyinotify not available, job queue is tracked by polling.")
+            return
+
+        try:
+            self._watch_manager = pyinotify.WatchManager()
+            mask = pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+                    pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM
+            for folder in self.folders:
+                self._watch_manager.add_watch(os.path.join(self.root, folder),
+                                              mask, quiet=False)
+            self._notifier = pyinotify.Notifier(self._watch_manager,
+                                                self._events.append,
+                                                timeout=0)
+        except Exception as e:
+            log.warning("Cannot watch job queue in %s (%s). "
+                        "Falling back to polling.", self.root, e)
+            self._watch_manager = None
+            self._notifier = None
+
+    @property
+    def is_watching(self):
+        return self._notifier is not None
+
+    def fileno(self):
+        """File descriptor which becomes readable when inotify events are
+        pending, or None if the index is not watching the queue.
+        """
+        if self._watch_manager is None:
+            return None
+        return self._watch_manager.get_fd()
+
+    def state(self, jobfile):
+        """Return the folder `jobfile` is in, or None if it is unknown.
+        """
+        return self.states.get(jobfile)
+
+    def move(self, jobfile, folder):
+        """Record a move made by this process, so it is visible immediately.
+        It is reported by the next refresh like any other transition.
+        """
+        with self._lock:
+            self._set(jobfile, folder)
+
+    def discard(self, jobfile):
+        with self._lock:
+            self._set(jobfile, None)
+
+    def reset(self):
+        """Forget everything. The next refresh reports every job file.
+        """
+        with self._lock:
+            self.states = dict()
+            self._changes = dict()
+            self._scanned = dict()
+            self._last_reconcile = 0
+
+    def refresh(self):
+        """Bring the index up to date. Returns the changes since the last
+        refresh as a list of (jobfile, old folder, new folder) tuples, where a
+        folder of None means the job file appeared or disappeared.
+        """
+        with self._lock:
+            full = self._read_events()
+
+            now = time.time()
+            if now - self._last_reconcile > self.reconcile_interval:
+                full = True
+                self._last_reconcile = now
+
+            if full or not self.is_watching:
+                for folder in self.folders:
+                    self._reconcile(folder, force=full)
+
+            transitions = []
+            for jobfile, old in self._changes.iteritems():
+                new = self.states.get(jobfile)
+                if new != old:
+                    transitions.append((jobfile, old, new))
+            self._changes = dict()
+            return transitions
+
+    def _set(self, jobfile, folder):
+        if jobfile not in self._changes:
+            self._changes[jobfile] = self.states.get(jobfile)
+        if folder is None:
+            self.states.pop(jobfile, None)
+        else:
+            self.states[jobfile] = folder
+
+    def _read_events(self):
+        """Apply pending inotify events. Returns True if events were lost and a
+        full reconciliation is necessary.
+        """
+        if self._notifier is None:
+            return False
+
+        overflow = False
+        try:
+            while self._notifier.check_events(timeout=0):
+                self._notifier.read_events()
+                self._notifier.process_events()
+        except Exception as e:
+            log.warning("Error reading job queue events: %s", e)
+            overflow = True
+
+        events, self._events[:] = list(self._events), []
+        for event in events:
+            if event.mask & pyinotify.IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if event.name is None or not event.name.endswith(JOB_SUFFIX):
+                continue
+            folder = os.path.basename(event.path)
+            if event.mask & (pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO):
+                self._set(event.name, folder)
+            elif self.states.get(event.name) == folder:
+                self._set(event.name, None)
+
+        return overflow
+
+    def _reconcile(self, folder, force=False):
+        """List `folder` again if it changed since it was last listed.
+        """
+        path = os.path.join(self.root, folder)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return
+
+        # A folder listed within the mtime granularity of its last change may
+        # have changed again without the mtime moving on.
+        last_mtime, scanned_at = self._scanned.get(folder, (None, None))
+        if not force and mtime == last_mtime and scanned_at - mtime > 1:
+            return
+
+        scanned_at = time.time()
+        present = set(list_job_files(path))
+        self._scanned[folder] = (mtime, scanned_at)
+
+        for jobfile in present:
+            if self.states.get(jobfile) != folder:
+                self._set(jobfile, folder)
+
+        for jobfile, jobfolder in self.states.items():
+            if jobfolder == folder and jobfile not in present:
+                self._set(jobfile, None)
@@ -0,0 +1,103 @@
+"""Secondary indexes over the jobs of a JobQueue.
+
+Every index maps an attribute value (an owner, a network id, a status...) to
+the ids of the matching jobs, sorted by the time they were queued. A page of
+a query is read by walking one of these lists backwards from a cursor, so it
+costs about as much as the rows it returns, however long the history is.
+"""
+import bisect
+import heapq
+from datetime import datetime
+
+
+def sort_key(job):
+    """The position of `job` in the indexes: when it was queued, with the
+    job id breaking ties.
+    """
+    return (job.enqueued_at or datetime.min, job.id)
+
+
+def encode_cursor(key):
+    enqueued_at, job_id = key
+    return '%s_%s' % (enqueued_at.strftime('%Y-%m-%dT%H:%M:%S.%f'), job_id)
+
+
+def decode_cursor(cursor):
+    enqueued_at, job_id = cursor.rsplit('_', 1)
+    return (datetime.strptime(enqueued_at, '%Y-%m-%dT%H:%M:%S.%f'), job_id)
+
+
+class SortedIndex(object):
+    """Sort keys of jobs grouped by the value of one attribute. Values are
+    compared as strings, so 3 and '3' are the same network.
+    """
+
+    def __init__(self):
+        self.groups = dict()
+
+    def add(self, value, key):
+        bisect.insort(self.groups.setdefault(str(value), []), key)
+
+    def remove(self, value, key):
+        group = self.groups.get(str(value))
+        if group is None:
+            return
+        pos = bisect.bisect_left(group, key)
+        if pos < len(group) and group[pos] == key:
+            del group[pos]
+        if not group:
+            del self.groups[str(value)]
+
+    def get(self, value):
+        return self.groups.get(str(value), [])
+
+    def size(self, values):
+        return sum(len(self.get(value)) for value in values)
+
+
+class _Descending(object):
+    """Reverses the order of sort keys for heapq, which only pops the
+    smallest item.
+    """
+    __slots__ = ('key', 'source')
+
+    def __init__(self, key, source):
+        self.key = key
+        self.source = source
+
+    def __lt__(self, other):
+        return self.key > other.key
+
+
+def _walk_back(group, before):
+    pos = bisect.bisect_left(group, before) if before is not None \
+            else len(group)
+    while pos > 0:
+        pos -= 1
+        yield group[pos]
+
+
+def iter_descending(groups, before=None):
+    """Yield the keys of all `groups` (sorted lists) which are smaller than
+    `before`, largest first.
+    """
+    if len(groups) == 1:
+        for key in _walk_back(groups[0], before):
+            yield key
+        return
+
+    heap = []
+    for group in groups:
+        walk = _walk_back(group, before)
+        for key in walk:
+            heap.append(_Descending(key, walk))
+            break
+    heapq.heapify(heap)
+    while heap:
+        item = heap[0]
+        yield item.key
+        for key in item.source:
+            heapq.heapreplace(heap, _Descending(key, item.source))
+            break
+        else:
+            heapq.heappop(heap)
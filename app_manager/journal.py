@@ -0,0 +1,174 @@
+"""An append-only journal of job state transitions.
+
+The web application and the queue runner append a line to
+<queue root>/journal.log for every transition of a job:
+
+    {"t": 1458820000.1, "e": "enqueue", "j": "<job id>", "f": "queued", "r": {...}}
+    {"t": 1458820002.3, "e": "claim", "j": "<job id>", "f": "tmp"}
+    {"t": 1458820002.3, "e": "start", "j": "<job id>", "f": "running"}
+    {"t": 1458820060.7, "e": "finish", "j": "<job id>", "f": "finished"}
+
+Enqueue entries carry the job's metadata ("r", see Job.to_record), so the
+queue can be restored from the journal without reading every job file.
+Once it grows beyond a size limit, the journal is folded into
+journal.snapshot and emptied, by the queue runner between jobs and by the
+web application when it rebuilds its queue.
+
+The queue folders stay the authority on where a job is: a missing or
+damaged journal only means more job files have to be read.
+"""
+import os
+import json
+import time
+import fcntl
+import errno
+import logging
+
+from contextlib import contextmanager
+
+
+log = logging.getLogger(__name__)
+
+JOURNAL_FILE = 'journal.log'
+SNAPSHOT_FILE = 'journal.snapshot'
+LOCK_FILE = 'journal.lock'
+
+# The event of a move into each folder
+MOVE_EVENTS = {'queued': 'restart',
+               'tmp': 'claim',
+               'running': 'start',
+               'finished': 'finish',
+               'failed': 'fail',
+               'deleted': 'delete'}
+
+
+class Journal(object):
+    """The journal of the job queue in `root`. The journal is folded into
+    the snapshot by `compact` once it is larger than `max_size` bytes.
+    """
+
+    version = 1
+
+    def __init__(self, root, max_size=4 * 2**20):
+        self.root = root
+        self.max_size = max_size
+        self.path = os.path.join(root, JOURNAL_FILE)
+        self.snapshot_path = os.path.join(root, SNAPSHOT_FILE)
+        self.lock_path = os.path.join(root, LOCK_FILE)
+
+    @contextmanager
+    def _locked(self, operation):
+        # Appends share the lock, compaction takes it exclusively
+        with open(self.lock_path, 'a') as lockfile:
+            fcntl.flock(lockfile, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _append(self, entries):
+        data = ''.join(json.dumps(entry, separators=(',', ':')) + '\n'
+                       for entry in entries)
+        try:
+            with self._locked(fcntl.LOCK_SH):
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                             0o644)
+                try:
+                    os.write(fd, data)
+                finally:
+                    os.close(fd)
+        except (IOError, OSError) as e:
+            # The queue folders remain correct, the journal only saves work
+            log.warning("Cannot write to job journal %s: %s", self.path, e)
+
+    def enqueued(self, records, event='enqueue'):
+        """Record new jobs, given as (record, folder) pairs.
+        """
+        now = time.time()
+        self._append([dict(t=now, e=event, j=record['id'], f=folder, r=record)
+                      for record, folder in records])
+
+    def moved(self, job_id, folder, event=None):
+        self._append([dict(t=time.time(), e=event or MOVE_EVENTS.get(folder,
+                                                                     'move'),
+                           j=job_id, f=folder)])
+
+    def removed(self, job_ids, event='archive'):
+        now = time.time()
+        self._append([dict(t=now, e=event, j=job_id, f=None)
+                      for job_id in job_ids])
+
+    def replay(self):
+        """Return the state recorded in the snapshot and journal as a dict of
+        job id -> record, with the job's folder under 'folder'. Returns None
+        if there is no journal or the snapshot cannot be read.
+        """
+        with self._locked(fcntl.LOCK_SH):
+            return self._replay()
+
+    def _replay(self):
+        jobs = dict()
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, 'r') as f:
+                    snapshot = json.load(f)
+                if snapshot.get('version') != self.version:
+                    return None
+                jobs = snapshot['jobs']
+            except (IOError, ValueError, KeyError) as e:
+                log.warning("Ignoring unreadable job journal snapshot %s: %s",
+                            self.snapshot_path, e)
+                return None
+        elif not os.path.exists(self.path):
+            return None
+
+        try:
+            journal = open(self.path, 'r')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return jobs
+
+        with journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Cut short by a crash. Whatever it recorded is
+                    # recovered from the queue folders.
+                    continue
+                job_id = entry['j']
+                if 'r' in entry:
+                    jobs[job_id] = dict(entry['r'], folder=entry['f'])
+                elif entry['f'] is None:
+                    jobs.pop(job_id, None)
+                elif job_id in jobs:
+                    jobs[job_id]['folder'] = entry['f']
+        return jobs
+
+    def compact(self, force=False):
+        """Fold the journal into the snapshot if it has grown beyond
+        `max_size` (or `force` is set) and start an empty journal.
+        """
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if not force and size < self.max_size:
+            return
+
+        started = time.time()
+        with self._locked(fcntl.LOCK_EX):
+            jobs = self._replay()
+            if jobs is None:
+                jobs = dict()
+            tmppath = '%s.%s.tmp' % (self.snapshot_path, os.getpid())
+            with open(tmppath, 'w') as f:
+                json.dump(dict(version=self.version, jobs=jobs), f,
+                          separators=(',', ':'))
+            os.rename(tmppath, self.snapshot_path)
+            # Replaying a journal onto a snapshot which already holds it
+            # gives the same state, so a crash right here does no harm.
+            open(self.path, 'w').close()
+        log.info("Compacted job journal of %s bytes, %s jobs, in %.2fs",
+                 size, len(jobs), time.time() - started)
@@ -0,0 +1,187 @@
+"""Read job logs and outputs incrementally.
+
+Log files of model runs can grow to hundreds of MB, so nothing in here reads
+a whole file. Callers keep a byte offset (cursor) and only ask for what was
+appended since.
+"""
+import os
+import json
+import logging
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+BLOCK_SIZE = 64 * 1024
+# Most read_from returns at a time
+READ_SIZE = 1024 * 1024
+
+OUTPUT_MARKER = '!!Output'
+PROGRESS_MARKER = '!!Progress'
+
+
+def _size(f):
+    f.seek(0, os.SEEK_END)
+    return f.tell()
+
+
+def read_from(path, offset=0, max_bytes=READ_SIZE):
+    """Return up to `max_bytes` written to `path` after `offset`, and the
+    offset to continue from. If the file is shorter than `offset` it has been
+    replaced and is read from the start.
+    """
+    if not os.path.exists(path):
+        return '', 0
+
+    with open(path, 'rb') as f:
+        if offset > _size(f):
+            offset = 0
+        f.seek(offset)
+        data = f.read(max_bytes)
+    return data, offset + len(data)
+
+
+def tail_lines(path, n=100):
+    """Return the last `n` lines of `path` and the offset of the end of the
+    file. The file is read backwards from its end, one block at a time.
+    """
+    if not os.path.exists(path):
+        return [], 0
+
+    with open(path, 'rb') as f:
+        end = pos = _size(f)
+        data = ''
+        while pos > 0 and data.count('\n') <= n:
+            step = min(BLOCK_SIZE, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+
+    return data.splitlines(True)[-n:] if n else [], end
+
+
+def parse_marker(line):
+    """Parse a line of job output. Returns ('output', text), ('progress',
+    (done, total)) or None if the line holds no marker.
+    """
+    line = line.strip()
+    if line.startswith(OUTPUT_MARKER):
+        return 'output', line.replace(OUTPUT_MARKER + ' ', '')
+    elif line.startswith(PROGRESS_MARKER):
+        parts = line.replace(PROGRESS_MARKER, '').split('/')
+        if len(parts) == 2:
+            try:
+                return 'progress', (int(parts[0]), int(parts[1]))
+            except ValueError:
+                pass
+    return None
+
+
+def scan_markers(path, offset=0):
+    """Collect the !!Output and !!Progress markers written to `path` after
+    `offset`. Only complete lines are considered. Returns the new output
+    lines, the latest progress (or None if no progress was reported) and the
+    offset to continue from.
+    """
+    output = []
+    progress = None
+
+    if not os.path.exists(path):
+        return output, progress, 0
+
+    with open(path, 'rb') as f:
+        if offset > _size(f):
+            offset = 0
+        f.seek(offset)
+
+        pending = ''
+        while True:
+            chunk = f.read(BLOCK_SIZE)
+            if not chunk:
+                break
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                offset += len(line) + 1
+                marker = parse_marker(line)
+                if marker is None:
+                    continue
+                elif marker[0] == 'output':
+                    output.append(marker[1])
+                else:
+                    progress = marker[1]
+
+    return output, progress, offset
+
+
+class MarkerState(object):
+    """The markers parsed from a job's output so far, and where parsing
+    stopped. `update` only parses what was appended since, so keeping one of
+    these per job makes repeated status requests cost as much as the new
+    output, not as much as the whole file.
+
+    With `persist`, the state is saved next to the output file (as
+    <outfile>.state) so it survives a restart of the web server.
+    """
+
+    def __init__(self, path, persist=False):
+        self.path = path
+        self.persist = persist
+        self.offset = 0
+        self.progress = None
+        self.output = []
+        self._lock = threading.Lock()
+        if persist:
+            self._load()
+
+    @property
+    def statefile(self):
+        return self.path + '.state'
+
+    def update(self):
+        with self._lock:
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                return self
+            if size == self.offset:
+                return self
+            if size < self.offset:
+                # The output file has been replaced
+                self.offset = 0
+                self.progress = None
+                self.output = []
+
+            output, progress, offset = scan_markers(self.path, self.offset)
+            self.output.extend(output)
+            if progress is not None:
+                self.progress = progress
+            changed = offset != self.offset
+            self.offset = offset
+
+            if changed and self.persist:
+                self._save()
+        return self
+
+    def _load(self):
+        try:
+            with open(self.statefile, 'r') as f:
+                state = json.load(f)
+            self.offset = state['offset']
+            self.progress = tuple(state['progress']) \
+                    if state['progress'] is not None else None
+            self.output = state['output']
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+    def _save(self):
+        tmpfile = self.statefile + '.tmp'
+        try:
+            with open(tmpfile, 'w') as f:
+                json.dump({'offset': self.offset,
+                           'progress': self.progress,
+                           'output': self.output}, f)
+            os.rename(tmpfile, self.statefile)
+        except (IOError, OSError) as e:
+            log.warning("Cannot save output state of %s: %s", self.path, e)
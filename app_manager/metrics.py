@@ -0,0 +1,198 @@
+"""In-process metrics, exposed in the Prometheus text format.
+
+Metrics only live in memory and are updated where things happen, so
+rendering them costs no filesystem access. Each web worker has its own
+metrics, as with any multi-process Prometheus target.
+"""
+import time
+import bisect
+import functools
+import threading
+
+
+# Durations of calls, in seconds
+CALL_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+# Durations of jobs waiting and running, in seconds
+JOB_BUCKETS = (1, 5, 15, 60, 300, 900, 1800, 3600, 3 * 3600, 6 * 3600,
+               12 * 3600, 24 * 3600)
+# Sizes of responses, in bytes, and of results, in items
+SIZE_BUCKETS = (10, 100, 1000, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = ['%s="%s"' % (name, _escape(value))
+             for name, value in zip(names, values)] + list(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = dict()
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for key, value in sorted(self.collect().items()):
+            lines.append('%s%s %s' % (self.name, _labels(self.labels, key),
+                                      _number(value)))
+        return lines
+
+    def collect(self):
+        with self._lock:
+            return dict(self.values)
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A gauge, either set explicitly or read from `collect`, a function
+    returning a dict of label values -> value, when rendered.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super(Gauge, self).__init__(name, help, labels)
+        if collect is not None:
+            self.collect = collect
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=CALL_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count per bucket (not cumulative), +Inf, and the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        with self._lock:
+            values = sorted((key, list(counts))
+                            for key, counts in self.values.items())
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                lines.append('%s_bucket%s %s' % (
+                    self.name,
+                    _labels(self.labels, key, ['le="%s"' % _number(bound)]),
+                    total))
+            lines.append('%s_sum%s %s' % (self.name,
+                                          _labels(self.labels, key),
+                                          _number(counts[-1])))
+            lines.append('%s_count%s %s' % (self.name,
+                                            _labels(self.labels, key), total))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+CALL_DURATION = REGISTRY.histogram(
+    'appmanager_call_duration_seconds',
+    "Time spent in app manager calls.", ['call'])
+CALL_RESULT_SIZE = REGISTRY.histogram(
+    'appmanager_call_result_items',
+    "Number of items (jobs, apps, lines...) returned by app manager calls.",
+    ['call'], buckets=SIZE_BUCKETS)
+HTTP_DURATION = REGISTRY.histogram(
+    'appmanager_http_request_duration_seconds',
+    "Time spent answering requests, by endpoint.", ['endpoint'])
+HTTP_RESPONSE_SIZE = REGISTRY.histogram(
+    'appmanager_http_response_size_bytes',
+    "Size of responses with a known length, by endpoint.", ['endpoint'],
+    buckets=SIZE_BUCKETS)
+JOB_WAIT = REGISTRY.histogram(
+    'appmanager_job_queue_wait_seconds',
+    "Time from queueing a job until a runner started it.", ['app_id'],
+    buckets=JOB_BUCKETS)
+JOB_RUN = REGISTRY.histogram(
+    'appmanager_job_run_seconds',
+    "Time a job ran, by app and outcome.",
+    ['app_id', 'status'], buckets=JOB_BUCKETS)
+
+
+def timed(call, size=len):
+    """Record the duration of calls to the decorated function, and the size
+    of its result as measured by `size`, by default its length if it has one.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            result = func(*args, **kwargs)
+            CALL_DURATION.observe(time.time() - started, call=call)
+            if size is not len or hasattr(result, '__len__'):
+                CALL_RESULT_SIZE.observe(size(result), call=call)
+            return result
+        return wrapper
+    return decorator
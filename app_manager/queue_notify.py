@@ -0,0 +1,75 @@
+"""Wake up idle queue runners as soon as a job is queued.
+
+Runners listen on a named pipe in the queue root. Anything that puts a job
+into queued/ writes a byte to it, which makes the runner's select() return.
+Writing never blocks: if no runner is listening the notification is dropped,
+and the runner picks the job up on its next (slow) poll instead.
+"""
+import os
+import errno
+import logging
+
+
+log = logging.getLogger(__name__)
+
+FIFO_NAME = 'wakeup.fifo'
+
+
+def notify(root):
+    """Tell the runners on the queue in `root` that there is work to do.
+    Returns True if a runner was listening.
+    """
+    if not hasattr(os, 'mkfifo'):
+        return False
+
+    try:
+        fd = os.open(os.path.join(root, FIFO_NAME),
+                     os.O_WRONLY | os.O_NONBLOCK)
+    except OSError as e:
+        # ENOENT: no runner has been started, ENXIO: none is listening
+        if e.errno not in (errno.ENOENT, errno.ENXIO):
+            log.warning("Cannot notify queue runners: %s", e)
+        return False
+
+    try:
+        os.write(fd, b'x')
+    except OSError as e:
+        # A full pipe means the runners have plenty of wakeups pending
+        if e.errno != errno.EAGAIN:
+            log.warning("Cannot notify queue runners: %s", e)
+    finally:
+        os.close(fd)
+    return True
+
+
+class WakeupListener(object):
+    """The reading end of the wakeup pipe, for use with select().
+    """
+
+    def __init__(self, root):
+        path = os.path.join(root, FIFO_NAME)
+        try:
+            os.mkfifo(path, 0o666)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self._fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        # Keep a writer open, otherwise the pipe reports EOF (and is always
+        # readable) once the first notifying process has closed it.
+        self._keepalive = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self._fd
+
+    def drain(self):
+        try:
+            while os.read(self._fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        os.close(self._keepalive)
+        os.close(self._fd)
@@ -0,0 +1,512 @@
+"""Run jobs from the app manager job queue.
+
+A replacement for the loop in queue_worker.sh which runs several jobs at once.
+Jobs move through the same folders `JobQueue` and `Job.status` know about:
+
+    queued/ -> tmp/ -> running/ -> finished/ or failed/
+
+A job is claimed by renaming it from queued/ to tmp/, which only one runner
+can do successfully, so several runners can share a queue. Jobs of a batch
+which is still being moved into queued/ are left alone (see job_batch.py).
+An idle runner sleeps until `JobQueue.enqueue` wakes it up through the pipe
+set up by queue_notify, so new jobs start right away. Which queued job starts next is
+decided by a FairShareScheduler, from the owner and priority in the job
+manifests. A job runs the argv of its manifest, without a shell; job files
+written before manifests are run by bash. Every move of a job is recorded in the job journal, and when
+it was claimed, started and ended, its exit code and its resource usage in
+logs/<job id>.run (see run_info.py).
+
+On SIGTERM the runner starts no more jobs and waits for the running ones to
+finish. On an interrupt (Ctrl-C) it terminates them and queues them again.
+
+Jobs are packed onto the machine by the CPU slots and memory their app
+declares in its plugin.xml, so small jobs run next to big ones as long as
+both fit. A job which does not fit is passed over by at most `max_skips`
+jobs behind it; after that no further jobs start until it fits.
+
+Usage:
+    python queue_runner.py --root ~/.hydra/apps/queue --slots 8 --memory 64G
+"""
+import os
+import sys
+import glob
+import time
+import errno
+import select
+import signal
+import logging
+import argparse
+import threading
+import subprocess
+import multiprocessing
+
+from pipes import quote
+
+from job_index import JOB_SUFFIX
+from journal import Journal
+from job_batch import pending_jobs
+from run_info import run_info_path, write_run_info, update_run_info, \
+        usage_from_rusage, now
+from job_file import read_manifest, legacy_manifest, parse_memory, \
+        DEFAULT_RESOURCES
+from queue_notify import WakeupListener
+from scheduling import FairShareScheduler, QueuedJob, ResourcePool
+
+
+log = logging.getLogger(__name__)
+
+
+def claim_job(root, jobfile):
+    """Move `jobfile` from queued/ to tmp/. Returns False if another runner
+    claimed it first.
+    """
+    try:
+        os.rename(os.path.join(root, 'queued', jobfile),
+                  os.path.join(root, 'tmp', jobfile))
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+    return True
+
+
+def prepare_model_workspace(root, job_id, script):
+    """If the job runs a model (assumed when a '-m' argument is given), link
+    the model and the text inputs next to it into model/<job_id> and point the
+    '-m' argument at the link, so logs written next to the model are kept
+    per job. Returns the script to run, or None if nothing had to change.
+    """
+    lines = script.split('\n')
+    for idx, line in enumerate(lines):
+        if line.startswith('#') or ' -m ' not in line:
+            continue
+
+        args = line.split(' ')
+        modelarg = args.index('-m') + 1
+        args[modelarg] = quote(link_model(root, job_id,
+                                          args[modelarg].replace("'", "")))
+        lines[idx] = ' '.join(args)
+        return '\n'.join(lines)
+
+    return None
+
+
+def prepare_model_args(root, job_id, argv):
+    """As prepare_model_workspace, for a job given as a list of arguments.
+    Returns the arguments to run, or None if nothing had to change.
+    """
+    if '-m' not in argv[:-1]:
+        return None
+    argv = list(argv)
+    modelarg = argv.index('-m') + 1
+    argv[modelarg] = link_model(root, job_id, argv[modelarg])
+    return argv
+
+
+def link_model(root, job_id, modelpath):
+    """Link the model at `modelpath` and the text inputs next to it into the
+    workspace of the job, and return the path of the model's link.
+    """
+    modelcontainer, modelfile = os.path.split(modelpath)
+
+    workspace = os.path.join(root, 'model', job_id)
+    if not os.path.isdir(workspace):
+        os.mkdir(workspace)
+
+    # Avoid cross-contamination of runs by clearing the workspace
+    for oldfile in os.listdir(workspace):
+        oldpath = os.path.join(workspace, oldfile)
+        if os.path.islink(oldpath) or os.path.isfile(oldpath):
+            os.remove(oldpath)
+
+    os.symlink(modelpath, os.path.join(workspace, modelfile))
+    for txtinput in glob.glob(os.path.join(modelcontainer, '*.txt')):
+        txtlink = os.path.join(workspace, os.path.basename(txtinput))
+        if not os.path.lexists(txtlink):
+            os.symlink(txtinput, txtlink)
+
+    return os.path.join(workspace, modelfile)
+
+
+def physical_memory():
+    """The memory of this machine in MB, or None if it cannot be found out.
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2**20
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def run_process(args, stdout=None, stderr=None, started=None):
+    """Run `args` and wait for it to exit, with its output written to the
+    files `stdout` and `stderr` if given. Returns its exit code (or minus
+    the signal which killed it, like subprocess.call) and its resource usage,
+    including that of every process it waited for.
+
+    The process leads a process group of its own, so it can be signalled
+    along with its children. `started` is called with the Popen object once
+    it runs.
+    """
+    outputs = [open(path, 'w') if path is not None else None
+               for path in (stdout, stderr)]
+    try:
+        process = subprocess.Popen(args, stdout=outputs[0], stderr=outputs[1],
+                                   preexec_fn=os.setpgrp)
+    finally:
+        for output in outputs:
+            if output is not None:
+                output.close()
+    if started is not None:
+        started(process)
+    while True:
+        try:
+            pid, status, rusage = os.wait4(process.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode, rusage
+
+
+class QueueRunner(object):
+    """Run queued jobs while their CPU slots and memory are free, by default
+    one slot per CPU and all of the machine's memory. Each job runs in its
+    own process, supervised by a thread which moves the job file on
+    when the process exits.
+    """
+
+    def __init__(self, root, slots=None, poll_interval=60, scheduler=None,
+                 memory=None, max_skips=100):
+        self.root = root
+        self.slots = slots or multiprocessing.cpu_count()
+        self.memory = memory or physical_memory()
+        self.poll_interval = poll_interval
+        self.scheduler = scheduler or FairShareScheduler()
+        self.pool = ResourcePool(self.slots, self.memory)
+        self.max_skips = max_skips
+        self.journal = Journal(self.root)
+        self.running = dict()
+        self.processes = dict()
+        self.stopping = False
+        self.interrupted = False
+        self._queued = dict()
+        self._skips = dict()
+
+        for folder in ('queued', 'tmp', 'running', 'finished', 'failed',
+                       'logs', 'model'):
+            if not os.path.isdir(os.path.join(self.root, folder)):
+                os.makedirs(os.path.join(self.root, folder))
+
+        self._lock = threading.RLock()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._listener = None
+        if hasattr(os, 'mkfifo'):
+            self._listener = WakeupListener(self.root)
+
+    def run_forever(self):
+        log.info("Starting job queue in %s with %s slots and %s MB memory.",
+                 self.root, self.slots, self.memory)
+        while not self.stopping:
+            self.fill_slots()
+            self.wait()
+            self.compact_journal()
+
+        log.info("Waiting for %s running jobs to finish.", len(self.running))
+        while self.running:
+            self.wait()
+
+    def compact_journal(self):
+        """Fold the journal into its snapshot once it has grown too large.
+        Most of it is written by runners, so they keep it short.
+        """
+        try:
+            self.journal.compact()
+        except (IOError, OSError):
+            log.exception("Cannot compact the job journal.")
+
+    def stop(self, *args):
+        self.stopping = True
+        self.wakeup()
+
+    def interrupt(self, grace=10):
+        """Stop at once: terminate the processes of all running jobs, which
+        are then queued again, and wait for them. Processes still running
+        after `grace` seconds are killed.
+        """
+        with self._lock:
+            self.stopping = True
+            self.interrupted = True
+            workers = list(self.running.values())
+            self._signal_jobs(signal.SIGTERM)
+        if workers:
+            log.info("Terminating %s running jobs.", len(workers))
+
+        deadline = time.time() + grace
+        for worker in workers:
+            # Joined in steps, so a further interrupt is not held up
+            while worker.is_alive():
+                if time.time() > deadline:
+                    with self._lock:
+                        self._signal_jobs(signal.SIGKILL)
+                worker.join(1)
+
+    def _signal_jobs(self, signum):
+        for process in self.processes.values():
+            try:
+                os.killpg(process.pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _started(self, jobfile, process):
+        with self._lock:
+            self.processes[jobfile] = process
+            if self.interrupted:
+                self._signal_jobs(signal.SIGTERM)
+
+    def wakeup(self):
+        os.write(self._wakeup_w, b'x')
+
+    def wait(self):
+        """Block until a job is queued, a job finishes or the poll interval
+        has passed.
+        """
+        fds = [self._wakeup_r]
+        if self._listener is not None:
+            fds.append(self._listener.fileno())
+        try:
+            readable, _, _ = select.select(fds, [], [], self.poll_interval)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if self._wakeup_r in readable:
+            os.read(self._wakeup_r, 4096)
+        if self._listener is not None and \
+                self._listener.fileno() in readable:
+            self._listener.drain()
+
+    def queued_jobs(self):
+        """The queued jobs, as QueuedJob records. The header of each job file
+        is only read the first time the job is seen.
+        """
+        queued = os.path.join(self.root, 'queued')
+        names = os.listdir(queued)
+        pending = pending_jobs(queued, names)
+        known = dict()
+        for jobfile in names:
+            if not jobfile.endswith(JOB_SUFFIX) or jobfile in pending:
+                continue
+            job = self._queued.get(jobfile)
+            if job is None:
+                try:
+                    manifest = read_manifest(os.path.join(queued, jobfile))
+                except IOError:
+                    # Claimed by another runner in the meantime
+                    continue
+                except ValueError:
+                    log.warning("Ignoring unreadable manifest of job %s",
+                                jobfile)
+                    manifest = legacy_manifest(dict(), None)
+                resources = dict(DEFAULT_RESOURCES)
+                resources.update(manifest['resources'] or {})
+                job = QueuedJob(jobfile, manifest['owner'],
+                                manifest['priority'],
+                                manifest['enqueued_at'] or '',
+                                manifest['app_id'], resources['cpus'],
+                                resources['memory'],
+                                resources['max_concurrent'])
+            known[jobfile] = job
+        self._queued = known
+        for jobfile in list(self._skips):
+            if jobfile not in known:
+                del self._skips[jobfile]
+        return known.values()
+
+    def fill_slots(self):
+        """Claim and start queued jobs, in the order of the scheduler, while
+        their resources are free. Jobs which do not fit may be passed over by
+        smaller ones, up to `max_skips` times each.
+        """
+        with self._lock:
+            if self.pool.full:
+                return
+
+            waiting = []
+            for job in self.scheduler.order(self.queued_jobs()):
+                if self.stopping or self.pool.full:
+                    break
+                if self.pool.app_limited(job):
+                    continue
+                if not self.pool.fits(job):
+                    if self._skips.get(job.name, 0) >= self.max_skips:
+                        # Let the machine drain until this job fits
+                        break
+                    waiting.append(job.name)
+                    continue
+                if claim_job(self.root, job.name):
+                    job_id = job.name[:-len(JOB_SUFFIX)]
+                    write_run_info(run_info_path(self.root, job_id),
+                                   dict(claimed_at=now()))
+                    self.journal.moved(job_id, 'tmp')
+                    self.scheduler.started(job)
+                    self.pool.acquire(job)
+                    self.start(job)
+                    for name in waiting:
+                        self._skips[name] = self._skips.get(name, 0) + 1
+
+    def start(self, job):
+        worker = threading.Thread(target=self._run, args=(job,),
+                                  name=job.name)
+        worker.daemon = True
+        with self._lock:
+            self.running[job.name] = worker
+        worker.start()
+
+    def _run(self, job):
+        try:
+            self.run_job(job.name)
+        except Exception:
+            if self.interrupted:
+                # Not started yet, it is run after the restart
+                log.warning("Job %s was interrupted.", job.name)
+                self._move(job.name, 'queued')
+                return
+            log.exception("Job %s could not be run.", job.name)
+            update_run_info(run_info_path(self.root,
+                                          job.name[:-len(JOB_SUFFIX)]),
+                            ended_at=now())
+            self._move(job.name, 'failed')
+        finally:
+            with self._lock:
+                del self.running[job.name]
+                self.processes.pop(job.name, None)
+                self.pool.release(job)
+            self.wakeup()
+
+    def run_job(self, jobfile):
+        job_id = jobfile[:-len(JOB_SUFFIX)]
+        log.info("Starting job %s", job_id)
+
+        tmppath = os.path.join(self.root, 'tmp', jobfile)
+        try:
+            argv = read_manifest(tmppath)['argv']
+        except ValueError:
+            argv = None
+        if argv is None:
+            with open(tmppath, 'r') as jf:
+                script = jf.read()
+
+        jobpath = self._move(jobfile, 'running')
+        info_path = run_info_path(self.root, job_id)
+        update_run_info(info_path, started_at=now())
+
+        # Logs of an earlier run are unlinked rather than truncated: older
+        # versions of the result cache hard linked them into cache entries.
+        for suffix in ('.log', '.out'):
+            logpath = os.path.join(self.root, 'logs', job_id + suffix)
+            if os.path.lexists(logpath):
+                os.remove(logpath)
+
+        started = lambda process: self._started(jobfile, process)
+        if argv is not None:
+            logs = os.path.join(self.root, 'logs')
+            status, rusage = run_process(
+                prepare_model_args(self.root, job_id, argv) or argv,
+                stdout=os.path.join(logs, '%s.out' % job_id),
+                stderr=os.path.join(logs, '%s.log' % job_id),
+                started=started)
+        else:
+            status, rusage = self.run_script(job_id, jobpath, script, started)
+
+        update_run_info(info_path, ended_at=now(), exit_code=status,
+                        usage=usage_from_rusage(rusage))
+        log.info("Job %s exited with status %s after %.1fs of CPU time, "
+                 "using up to %s KB of memory", job_id, status,
+                 rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss)
+        if self.interrupted:
+            log.info("Queueing interrupted job %s again.", job_id)
+            self._move(jobfile, 'queued')
+        else:
+            self._move(jobfile, 'failed' if status != 0 else 'finished')
+
+    def run_script(self, job_id, jobpath, script, started=None):
+        """Run a job file written before manifests, which redirects the
+        output of the job itself.
+        """
+        amended = prepare_model_workspace(self.root, job_id, script)
+        if amended is not None:
+            runpath = jobpath + '.amended'
+            with open(runpath, 'w') as af:
+                af.write(amended)
+        else:
+            runpath = jobpath
+
+        try:
+            return run_process(['/bin/bash', runpath], started=started)
+        finally:
+            if amended is not None:
+                os.remove(runpath)
+
+    def _move(self, jobfile, folder):
+        for current in ('tmp', 'running'):
+            src = os.path.join(self.root, current, jobfile)
+            if os.path.exists(src):
+                dst = os.path.join(self.root, folder, jobfile)
+                os.rename(src, dst)
+                self.journal.moved(jobfile[:-len(JOB_SUFFIX)], folder)
+                return dst
+        log.warning("Job %s has gone missing.", jobfile)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--root', default='~/.hydra/apps/queue',
+                        help="Root folder of the job queue.")
+    parser.add_argument('--slots', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="Number of CPU slots shared by running jobs. "
+                             "A job takes one slot unless its app asks "
+                             "for more.")
+    parser.add_argument('--memory', type=parse_memory,
+                        help="Memory shared by running jobs, e.g. 64G "
+                             "(default: all of the machine's memory).")
+    parser.add_argument('--max-skips', type=int, default=100,
+                        help="How many jobs may start ahead of a job which "
+                             "does not fit before the runner waits for it.")
+    parser.add_argument('--poll-interval', type=float, default=60,
+                        help="Seconds between checks for jobs which were "
+                             "queued without waking up the runner.")
+    parser.add_argument('--owner-weight', action='append', default=[],
+                        metavar='OWNER=WEIGHT',
+                        help="Share of the queue of a user relative to "
+                             "others (default 1). May be repeated.")
+    args = parser.parse_args(argv)
+
+    owner_weights = dict()
+    for owner_weight in args.owner_weight:
+        owner, weight = owner_weight.split('=', 1)
+        owner_weights[owner] = float(weight)
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    runner = QueueRunner(os.path.expanduser(args.root), slots=args.slots,
+                         poll_interval=args.poll_interval,
+                         scheduler=FairShareScheduler(owner_weights),
+                         memory=args.memory, max_skips=args.max_skips)
+    signal.signal(signal.SIGTERM, runner.stop)
+    try:
+        runner.run_forever()
+    except KeyboardInterrupt:
+        runner.interrupt()
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,69 @@
+import os
+import json
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class RegistryCache(object):
+    """An on-disk cache of parsed 'plugin.xml' files. Entries are keyed by the
+    path of the file and are only valid while its mtime and size are
+    unchanged, so a scan only needs to parse (and hash) plugins which were
+    added or modified since the cache was written.
+    """
+
+    version = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = dict()
+        self.dirty = False
+        self._load()
+
+    def _load(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == self.version:
+                self.entries = data['entries']
+        except (IOError, ValueError, KeyError) as e:
+            log.warning("Ignoring unreadable registry cache %s: %s",
+                        self.path, e)
+
+    def get(self, pxml, stat):
+        """Return the cached state of the app defined in `pxml`, or None if
+        the file changed since it was cached.
+        """
+        entry = self.entries.get(pxml)
+        if entry is not None and entry['mtime'] == stat.st_mtime and \
+                entry['size'] == stat.st_size:
+            return entry['app']
+        return None
+
+    def put(self, pxml, stat, state):
+        self.entries[pxml] = dict(mtime=stat.st_mtime, size=stat.st_size,
+                                  app=state)
+        self.dirty = True
+
+    def prune(self, keep):
+        """Drop the entries of all files not in `keep`.
+        """
+        for pxml in list(self.entries):
+            if pxml not in keep:
+                del self.entries[pxml]
+                self.dirty = True
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        tmppath = '%s.%s.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmppath, 'w') as f:
+                json.dump(dict(version=self.version, entries=self.entries), f)
+            os.rename(tmppath, self.path)
+            self.dirty = False
+        except (IOError, OSError) as e:
+            log.warning("Cannot write registry cache %s: %s", self.path, e)
@@ -0,0 +1,207 @@
+"""Reuse the results of finished jobs for identical jobs.
+
+Two jobs are identical if they run the same version of an app (its
+unique_id) with the same command line and the same contents of the input
+files given as options. Input files are named by their contents in the key,
+so uploads saved under different names still match. The logs and model
+folder of a finished job are kept in the cache, so an identical job can be
+completed by putting them into place instead of running it again.
+
+Logs are copied: a job which is restarted writes its logs anew, which must
+not truncate the cached ones or those of jobs reusing them. Model folders
+are hard linked; before a job runs again, the queue runner unlinks the files
+its model link left in them.
+
+Data read from or written to Hydra by the app is not part of the key, so
+only apps declaring <plugin_cacheable>true</plugin_cacheable> in their
+plugin.xml are cached.
+"""
+import os
+import json
+import time
+import errno
+import shutil
+import hashlib
+import logging
+
+
+log = logging.getLogger(__name__)
+
+ENTRY_FILE = 'entry.json'
+CHUNK_SIZE = 1024 * 1024
+
+
+def _link_file(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(src, dst)
+
+
+def _link_tree(src, dst):
+    """Recreate the folder `src` at `dst`, hard linking files and copying
+    symbolic links.
+    """
+    os.makedirs(dst)
+    for name in os.listdir(src):
+        srcpath = os.path.join(src, name)
+        dstpath = os.path.join(dst, name)
+        if os.path.islink(srcpath):
+            os.symlink(os.readlink(srcpath), dstpath)
+        elif os.path.isdir(srcpath):
+            _link_tree(srcpath, dstpath)
+        elif os.path.isfile(srcpath):
+            _link_file(srcpath, dstpath)
+
+
+def tree_size(path):
+    """The size of the files below `path` in bytes, links not followed.
+    """
+    size = 0
+    for root, folders, files in os.walk(path):
+        for name in files:
+            filepath = os.path.join(root, name)
+            if not os.path.islink(filepath):
+                size += os.path.getsize(filepath)
+    return size
+
+
+class ResultCache(object):
+    """Finished job results in `root`, one folder per key holding the job's
+    log and output (job.log, job.out), its model folder (model/) and an
+    entry.json describing it.
+
+    Entries older than `max_age` seconds are dropped, as are the oldest
+    entries once all of them together take more than `max_size` bytes.
+    """
+
+    def __init__(self, root, max_age=7 * 86400, max_size=1024 * 2**20):
+        self.root = root
+        self.max_age = max_age
+        self.max_size = max_size
+        self._digests = dict()
+
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    def key(self, unique_id, command, input_files=()):
+        """The cache key of a job of the app `unique_id` running `command`
+        on `input_files`.
+        """
+        key = hashlib.sha1()
+        key.update(unique_id)
+        if isinstance(command, unicode):
+            command = command.encode('utf-8')
+        # Longest first, so no path is replaced within a longer one
+        for path in sorted(set(input_files), key=len, reverse=True):
+            if isinstance(path, unicode):
+                path = path.encode('utf-8')
+            command = command.replace(path, '<input %s>' % self._digest(path))
+        key.update('\0' + command)
+        return key.hexdigest()
+
+    def _digest(self, path):
+        stat = os.stat(path)
+        cachekey = (path, stat.st_mtime, stat.st_size)
+        if cachekey not in self._digests:
+            digest = hashlib.md5()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            self._digests[cachekey] = digest.hexdigest()
+        return self._digests[cachekey]
+
+    def lookup(self, key):
+        """Return the entry stored under `key`, or None.
+        """
+        try:
+            with open(os.path.join(self.root, key, ENTRY_FILE), 'r') as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if time.time() - entry['stored_at'] > self.max_age:
+            return None
+        return entry
+
+    def store(self, key, job_id, logfile, outfile, model_dir):
+        """Keep the results of the finished job `job_id` under `key`. Does
+        nothing if there already is an entry for `key`.
+        """
+        entrypath = os.path.join(self.root, key)
+        if os.path.isdir(entrypath):
+            return
+
+        tmppath = os.path.join(self.root, '.%s.%s.tmp' % (key, os.getpid()))
+        try:
+            os.makedirs(tmppath)
+            for src, name in ((logfile, 'job.log'), (outfile, 'job.out')):
+                if os.path.isfile(src):
+                    shutil.copyfile(src, os.path.join(tmppath, name))
+            if os.path.isdir(model_dir):
+                _link_tree(model_dir, os.path.join(tmppath, 'model'))
+            entry = dict(job_id=job_id, stored_at=time.time(),
+                         size=tree_size(tmppath))
+            with open(os.path.join(tmppath, ENTRY_FILE), 'w') as f:
+                json.dump(entry, f)
+            os.rename(tmppath, entrypath)
+        except (IOError, OSError) as e:
+            shutil.rmtree(tmppath, ignore_errors=True)
+            # Someone else stored the same result first
+            if getattr(e, 'errno', None) not in (errno.EEXIST, errno.ENOTEMPTY):
+                log.warning("Cannot cache results of job %s: %s", job_id, e)
+            return
+
+        log.info("Cached results of job %s as %s", job_id, key)
+        self.evict()
+
+    def restore(self, key, logfile, outfile, model_dir):
+        """Put the results stored under `key` into place for a new job.
+        Returns the entry, or None if there is no entry for `key` (anymore).
+        """
+        entry = self.lookup(key)
+        if entry is None:
+            return None
+        entrypath = os.path.join(self.root, key)
+        try:
+            for name, dst in (('job.log', logfile), ('job.out', outfile)):
+                if os.path.isfile(os.path.join(entrypath, name)):
+                    shutil.copyfile(os.path.join(entrypath, name), dst)
+            if os.path.isdir(os.path.join(entrypath, 'model')):
+                _link_tree(os.path.join(entrypath, 'model'), model_dir)
+        except (IOError, OSError) as e:
+            # Evicted while restoring
+            log.warning("Cannot reuse cached results %s: %s", key, e)
+            for path in (logfile, outfile):
+                if os.path.isfile(path):
+                    os.remove(path)
+            shutil.rmtree(model_dir, ignore_errors=True)
+            return None
+        return entry
+
+    def evict(self, now=None):
+        """Drop expired entries, then the oldest ones until the cache fits
+        into `max_size`.
+        """
+        now = now or time.time()
+        entries = []
+        for key in os.listdir(self.root):
+            if key.startswith('.'):
+                continue
+            entry = self.lookup(key)
+            if entry is None or now - entry['stored_at'] > self.max_age:
+                self._drop(key)
+            else:
+                entries.append((entry['stored_at'], entry['size'], key))
+
+        total = sum(size for _, size, _ in entries)
+        for stored_at, size, key in sorted(entries):
+            if total <= self.max_size:
+                break
+            self._drop(key)
+            total -= size
+
+    def _drop(self, key):
+        log.info("Dropping cached results %s", key)
+        shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
@@ -0,0 +1,340 @@
+"""Move completed jobs out of the job queue into compressed archives.
+
+Finished, failed and deleted jobs are archived when they are older than
+`max_age` days, when their owner has more than `per_user` completed jobs, or
+while the logs and model folders of all completed jobs take more than
+`max_size` bytes, oldest first. Deleted jobs are archived on the next pass.
+None of these limits is set by default, and without one nothing is archived.
+
+Archived jobs are appended to one zip file per day they were queued on,
+
+    archive/2016-03-01.zip
+        <job id>/<job id>.job
+        <job id>/logs/<job id>.log
+        <job id>/model/...
+
+and their metadata to archive/index.jsonl, which `ArchiveIndex` queries.
+"""
+import os
+import json
+import time
+import fcntl
+import errno
+import shutil
+import logging
+import zipfile
+import threading
+
+from job_file import read_manifest
+from job_index import JOB_SUFFIX
+from run_info import RUN_INFO_SUFFIX, read_run_info
+from result_cache import tree_size
+
+
+log = logging.getLogger(__name__)
+
+COMPLETED_FOLDERS = ('finished', 'failed', 'deleted')
+INDEX_FILE = 'index.jsonl'
+LOCK_FILE = '.lock'
+
+# Manifest fields kept in the archive index
+METADATA_FIELDS = ('owner', 'app_id', 'network_id', 'network_name',
+                   'scenario_id', 'scenario_name', 'created_at', 'enqueued_at',
+                   'sweep_id')
+
+
+class ArchiveIndex(object):
+    """The metadata of archived jobs, one JSON object per line.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, records):
+        with open(self.path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+    def query(self, owner=None, network_id=None, app_id=None, since=None,
+              until=None, limit=None):
+        """Return the archived jobs matching all given criteria, most
+        recently queued first. `since` and `until` compare to 'enqueued_at'
+        and are given in the same format, e.g. '2016-03-01'.
+        """
+        if not os.path.isfile(self.path):
+            return []
+        matches = []
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    continue
+                if owner is not None and str(record.get('owner')) != str(owner):
+                    continue
+                if network_id is not None and \
+                        str(record.get('network_id')) != str(network_id):
+                    continue
+                if app_id is not None and record.get('app_id') != app_id:
+                    continue
+                enqueued_at = record.get('enqueued_at') or ''
+                if since is not None and enqueued_at < since:
+                    continue
+                if until is not None and enqueued_at >= until:
+                    continue
+                matches.append(record)
+        matches.sort(key=lambda r: r.get('enqueued_at'), reverse=True)
+        return matches[:limit] if limit is not None else matches
+
+
+class RetentionEngine(object):
+    """Archive completed jobs of `job_queue` by the policies described in
+    the module docstring, every `interval` seconds in a background thread.
+    A lock file makes sure only one process compacts a queue at a time.
+    """
+
+    def __init__(self, job_queue, max_age=None, per_user=None, max_size=None,
+                 interval=3600):
+        self.job_queue = job_queue
+        self.max_age = max_age
+        self.per_user = per_user
+        self.max_size = max_size
+        self.interval = interval
+        self.archive_dir = os.path.join(job_queue.root,
+                                        job_queue.folders['archive'])
+        self.index = ArchiveIndex(os.path.join(self.archive_dir, INDEX_FILE))
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_age is not None or self.per_user is not None or \
+            self.max_size is not None
+
+    def start(self):
+        """Start the background thread, if any limit is set. Like
+        JobEventFeed, this is done lazily so it happens after a pre-forking
+        server has forked.
+        """
+        if not self.enabled:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='job-retention')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                log.exception("Error compacting the job queue.")
+            time.sleep(self.interval)
+
+    def run_once(self, now=None):
+        """Archive all jobs due for it. Returns the number of jobs archived,
+        or None if another process is compacting the queue.
+        """
+        with open(os.path.join(self.archive_dir, LOCK_FILE), 'w') as lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return None
+                raise
+
+            started = time.time()
+            due = self.select(self.completed_jobs(), now or started)
+            for day, jobs in sorted(due.items()):
+                self.archive(day, jobs)
+            self.job_queue.journal.compact()
+            if due:
+                log.info("Archived %s jobs in %.1fs",
+                         sum(len(jobs) for jobs in due.values()),
+                         time.time() - started)
+            return sum(len(jobs) for jobs in due.values())
+
+    def completed_jobs(self):
+        """Return the manifest of every completed job, together with its id,
+        job file and status.
+        """
+        jobs = []
+        for state in COMPLETED_FOLDERS:
+            folder = os.path.join(self.job_queue.root,
+                                  self.job_queue.folders[state])
+            for jobfile in os.listdir(folder):
+                if not jobfile.endswith(JOB_SUFFIX):
+                    continue
+                try:
+                    manifest = read_manifest(os.path.join(folder, jobfile))
+                except IOError:
+                    continue
+                except ValueError:
+                    log.warning("Not archiving job %s, its manifest cannot "
+                                "be read.", jobfile)
+                    continue
+                jobs.append(dict(manifest, job_id=jobfile[:-len(JOB_SUFFIX)],
+                                 jobfile=jobfile, status=state))
+        return jobs
+
+    def select(self, jobs, now):
+        """Return the jobs due for archiving, as a dict of day -> jobs.
+        """
+        cutoff = ''
+        if self.max_age is not None:
+            cutoff = time.strftime('%Y-%m-%d %H:%M:%S',
+                                   time.localtime(now - self.max_age * 86400))
+        jobs.sort(key=lambda j: j.get('enqueued_at') or '', reverse=True)
+
+        due = dict()
+        kept = []
+        per_owner = dict()
+        for job in jobs:
+            if job['status'] == 'deleted' or \
+                    (job.get('enqueued_at') or '') < cutoff:
+                due[job['job_id']] = job
+                continue
+            owner_count = per_owner[job.get('owner')] = \
+                    per_owner.get(job.get('owner'), 0) + 1
+            if self.per_user is not None and owner_count > self.per_user:
+                due[job['job_id']] = job
+            else:
+                kept.append(job)
+
+        if self.max_size is not None:
+            size = 0
+            for job in kept:
+                job['size'] = self._hot_size(job['job_id'])
+                size += job['size']
+            # Oldest first
+            for job in reversed(kept):
+                if size <= self.max_size:
+                    break
+                due[job['job_id']] = job
+                size -= job['size']
+
+        days = dict()
+        for job in due.values():
+            day = (job.get('enqueued_at') or '')[:10] or 'undated'
+            days.setdefault(day, []).append(job)
+        return days
+
+    def _paths(self, job_id):
+        """The files and folders a job keeps in the queue besides its job
+        file, as (path, name in the archive).
+        """
+        root, folders = self.job_queue.root, self.job_queue.folders
+        logs = os.path.join(root, folders['logs'])
+        return [(os.path.join(logs, '%s.log' % job_id), 'logs/%s.log' % job_id),
+                (os.path.join(logs, '%s.out' % job_id), 'logs/%s.out' % job_id),
+                (os.path.join(logs, job_id + RUN_INFO_SUFFIX),
+                 'logs/%s%s' % (job_id, RUN_INFO_SUFFIX)),
+                (os.path.join(root, folders['model'], job_id), 'model')]
+
+    def _hot_size(self, job_id):
+        size = 0
+        for path, name in self._paths(job_id):
+            if os.path.isfile(path):
+                size += os.path.getsize(path)
+            elif os.path.isdir(path):
+                size += tree_size(path)
+        return size
+
+    def archive(self, day, jobs):
+        """Move `jobs` into the archive of `day`.
+        """
+        root, folders = self.job_queue.root, self.job_queue.folders
+        staging = os.path.join(root, folders['staging'])
+
+        # Take the job files out of the queue first, so the jobs cannot be
+        # restarted or deleted while they are being archived.
+        claimed = []
+        with self.job_queue.lock:
+            for job in jobs:
+                try:
+                    os.rename(os.path.join(root, folders[job['status']],
+                                           job['jobfile']),
+                              os.path.join(staging, job['jobfile']))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                self.job_queue.index.discard(job['jobfile'])
+                claimed.append(job)
+
+        archive = os.path.join(self.archive_dir, '%s.zip' % day)
+        archived_at = time.strftime('%Y-%m-%d %H:%M:%S')
+        records = []
+        try:
+            self._write_archive(archive, claimed, archived_at, records)
+        except Exception:
+            # Put the jobs back, they are retried on the next pass
+            for job in claimed:
+                os.rename(os.path.join(staging, job['jobfile']),
+                          os.path.join(root, folders[job['status']],
+                                       job['jobfile']))
+                self.job_queue.index.move(job['jobfile'],
+                                          folders[job['status']])
+            raise
+
+        self.index.append(records)
+
+        for job in claimed:
+            self._remove(job)
+        self.job_queue.journal.removed([job['job_id'] for job in claimed])
+
+    def _write_archive(self, archive, jobs, archived_at, records):
+        staging = os.path.join(self.job_queue.root,
+                               self.job_queue.folders['staging'])
+        with zipfile.ZipFile(archive, 'a', zipfile.ZIP_DEFLATED,
+                             allowZip64=True) as zf:
+            for job in jobs:
+                job_id = job['job_id']
+                zf.write(os.path.join(staging, job['jobfile']),
+                         '%s/%s' % (job_id, job['jobfile']))
+                for path, name in self._paths(job_id):
+                    if os.path.isfile(path):
+                        zf.write(path, '%s/%s' % (job_id, name))
+                    elif os.path.isdir(path):
+                        for dirpath, dirnames, filenames in os.walk(path):
+                            for filename in filenames:
+                                filepath = os.path.join(dirpath, filename)
+                                # Links to the model and its inputs
+                                if os.path.islink(filepath):
+                                    continue
+                                zf.write(filepath, '%s/%s/%s' % (
+                                    job_id, name,
+                                    os.path.relpath(filepath, path)))
+                record = dict((field, job.get(field))
+                              for field in METADATA_FIELDS)
+                record.update(job_id=job_id, status=job['status'],
+                              run=read_run_info(os.path.join(
+                                  self.job_queue.root,
+                                  self.job_queue.folders['logs'],
+                                  job_id + RUN_INFO_SUFFIX)),
+                              archive=os.path.basename(archive),
+                              archived_at=archived_at)
+                records.append(record)
+
+    def _remove(self, job):
+        root, folders = self.job_queue.root, self.job_queue.folders
+        job_id = job['job_id']
+        os.remove(os.path.join(root, folders['staging'], job['jobfile']))
+        for path, name in self._paths(job_id):
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.lexists(path):
+                os.remove(path)
+        state = os.path.join(root, folders['logs'], '%s.out.state' % job_id)
+        if os.path.exists(state):
+            os.remove(state)
+        for artifacts in ('nativelogs', 'nativeoutputs'):
+            cache = os.path.join(root, folders['cache'], artifacts)
+            if not os.path.isdir(cache):
+                continue
+            for cached in os.listdir(cache):
+                if cached.startswith(job_id + '-'):
+                    os.remove(os.path.join(cache, cached))
@@ -0,0 +1,64 @@
+"""What the queue runner records about the run of a job.
+
+The runner keeps a small JSON file next to the job's log, logs/<job id>.run:
+
+    {"claimed_at": "2016-03-01 12:00:00.123456",
+     "started_at": "2016-03-01 12:00:00.130000",
+     "ended_at": "2016-03-01 12:05:13.000001",
+     "exit_code": 0,
+     "usage": {"utime": 301.2, "stime": 4.1, "maxrss_kb": 20480512,
+               "inblock": 1024, "oublock": 20480}}
+
+The usage comes from wait4 and covers the job's process and everything it
+waited for. Timestamps are written as str(datetime).
+"""
+import os
+import json
+
+from datetime import datetime
+
+
+RUN_INFO_SUFFIX = '.run'
+
+
+def run_info_path(root, job_id):
+    return os.path.join(root, 'logs', job_id + RUN_INFO_SUFFIX)
+
+
+def read_run_info(path):
+    """Return the run info at `path`, or an empty dict if there is none.
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return dict()
+
+
+def write_run_info(path, info):
+    """Replace the run info at `path`. Only the runner of a job writes to
+    it, and readers always see a complete file.
+    """
+    tmppath = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmppath, 'w') as f:
+        json.dump(info, f)
+    os.rename(tmppath, path)
+
+
+def update_run_info(path, **info):
+    """Add `info` to the run info at `path`.
+    """
+    current = read_run_info(path)
+    current.update(info)
+    write_run_info(path, current)
+    return current
+
+
+def usage_from_rusage(rusage):
+    return dict(utime=rusage.ru_utime, stime=rusage.ru_stime,
+                maxrss_kb=rusage.ru_maxrss, inblock=rusage.ru_inblock,
+                oublock=rusage.ru_oublock)
+
+
+def now():
+    return str(datetime.now())
@@ -0,0 +1,147 @@
+"""Decide which queued job a runner starts next.
+"""
+import heapq
+import collections
+
+from job_file import priority_weight
+
+
+QueuedJob = collections.namedtuple('QueuedJob',
+                                   ['name', 'owner', 'priority', 'enqueued_at',
+                                    'app_id', 'cpus', 'memory',
+                                    'max_concurrent'])
+
+
+class FairShareScheduler(object):
+    """Weighted round-robin between owners and, within the jobs of an owner,
+    between priority levels.
+
+    Every owner has a virtual time which advances by 1/weight for each job of
+    theirs that is started. The next job comes from the owner with queued jobs
+    and the lowest virtual time, so owners take turns however many jobs each
+    of them has queued. The priority levels of an owner take turns the same
+    way, weighted by `priority_weight`. Within a level, jobs run oldest first.
+
+    An owner's virtual time is never behind the time of the last job started,
+    so owners cannot save up turns while they have nothing queued.
+    """
+
+    def __init__(self, owner_weights=None, default_weight=1):
+        self.owner_weights = owner_weights or dict()
+        self.default_weight = default_weight
+        self.owner_vtime = dict()
+        self.level_vtime = dict()
+        self.clock = 0.0
+        self.level_clock = dict()
+
+    def owner_weight(self, owner):
+        return float(self.owner_weights.get(owner, self.default_weight))
+
+    def _owner_start(self, owner):
+        return max(self.owner_vtime.get(owner, 0.0), self.clock)
+
+    def _level_start(self, owner, priority):
+        return max(self.level_vtime.get((owner, priority), 0.0),
+                   self.level_clock.get(owner, 0.0))
+
+    def order(self, jobs):
+        """Return `jobs` (a list of QueuedJob) in the order they would be
+        started. Nothing is recorded until `started` is called, so a caller
+        can skip jobs which cannot be started right now.
+        """
+        levels = dict()
+        for job in sorted(jobs, key=lambda j: (j.enqueued_at, j.name)):
+            levels.setdefault(job.owner, dict()).setdefault(
+                job.priority, collections.deque()).append(job)
+
+        level_vtime = dict()
+        heap = []
+        for owner, owner_levels in levels.items():
+            heap.append((self._owner_start(owner), owner))
+            for priority in owner_levels:
+                level_vtime[(owner, priority)] = \
+                        self._level_start(owner, priority)
+        heapq.heapify(heap)
+
+        ordered = []
+        while heap:
+            vtime, owner = heapq.heappop(heap)
+            owner_levels = levels[owner]
+            priority = min(owner_levels,
+                           key=lambda p: (level_vtime[(owner, p)], -p))
+            ordered.append(owner_levels[priority].popleft())
+
+            level_vtime[(owner, priority)] += 1 / float(priority_weight(priority))
+            if not owner_levels[priority]:
+                del owner_levels[priority]
+            if owner_levels:
+                heapq.heappush(heap, (vtime + 1 / self.owner_weight(owner),
+                                      owner))
+
+        return ordered
+
+    def started(self, job):
+        """Charge the owner and priority level of `job` for starting it.
+        """
+        start = self._owner_start(job.owner)
+        self.clock = start
+        self.owner_vtime[job.owner] = start + 1 / self.owner_weight(job.owner)
+
+        level = (job.owner, job.priority)
+        start = self._level_start(*level)
+        self.level_clock[job.owner] = start
+        self.level_vtime[level] = start + 1 / float(priority_weight(job.priority))
+
+
+class ResourcePool(object):
+    """The CPU slots and memory (in MB) of the machine jobs run on, and the
+    number of running jobs of each app.
+
+    A job asking for more than the machine has is treated as asking for all
+    of it, so it runs alone rather than never. With `memory` None, memory is
+    not accounted for.
+    """
+
+    def __init__(self, cpus, memory=None):
+        self.cpus = cpus
+        self.memory = memory
+        self.free_cpus = cpus
+        self.free_memory = memory
+        self.app_jobs = dict()
+
+    def _request(self, job):
+        memory = 0 if self.memory is None else min(job.memory, self.memory)
+        return min(job.cpus, self.cpus), memory
+
+    @property
+    def full(self):
+        return self.free_cpus <= 0
+
+    def fits(self, job):
+        """Whether the CPU slots and memory `job` needs are free.
+        """
+        cpus, memory = self._request(job)
+        return cpus <= self.free_cpus and \
+                (self.memory is None or memory <= self.free_memory)
+
+    def app_limited(self, job):
+        """Whether the app of `job` already runs as many jobs as it allows.
+        """
+        return job.max_concurrent is not None and \
+                self.app_jobs.get(job.app_id, 0) >= job.max_concurrent
+
+    def acquire(self, job):
+        cpus, memory = self._request(job)
+        self.free_cpus -= cpus
+        if self.memory is not None:
+            self.free_memory -= memory
+        self.app_jobs[job.app_id] = self.app_jobs.get(job.app_id, 0) + 1
+
+    def release(self, job):
+        cpus, memory = self._request(job)
+        self.free_cpus += cpus
+        if self.memory is not None:
+            self.free_memory += memory
+        self.app_jobs[job.app_id] -= 1
+        if not self.app_jobs[job.app_id]:
+            del self.app_jobs[job.app_id]
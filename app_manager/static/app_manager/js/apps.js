@@ -155,7 +155,9 @@ $(document).on('click', '#run-app-button', function(){
 
         $('#run_app_modal').modal('hide');
 
-        poll_jobs()
+        if (job_stream == null){
+            poll_jobs()
+        }
     }
 
     var error = function(){
@@ -187,40 +189,50 @@ $(document).on('click', '#run-app-button', function(){
 
 /*********************Tracking Apps******************************/
 
+var job_stream = null
+
+var render_jobs = function(resp){
+    $('#joblist').empty()
+
+    var active_jobs = []
+
+    for (var i=0; i<resp.length; i++){
+        var j = resp[i]
+        jobs[j.jobid] = j
+        if (j.status == 'queued'){
+            icon = 'fa fa-ellipsis-v'
+            active_jobs.push(j.job_id)
+        }else if (j.status == 'running'){
+            icon = 'fa fa-spinner fa-spin'
+            active_jobs.push(j.job_id)
+        }else if (j.status == 'finished'){
+            icon = 'fa fa-check'
+        }else if (j.status == 'failed'){
+            icon = 'fa fa-exclamation-circle'
+        }else{
+            icon = 'fa fa-questionmark'
+        }
+
+        var name = j.scenario_name
+        if (name == '' || name == undefined || name == null){
+            name = app_dict[j.app_id]['name'];
+        }
+        $('#joblist').append("<div class='btn jobstatus "+j.status+"' data-toggle='modal' data-target='#job_status_modal' scenario_id='"+j.scenario_id+"' job-id='"+j.jobid+"' app-id='"+j.app_id+"'><div class='name'>"+name+"</div><span class='icon'><i class='"+icon+"'></i></span><span class='inner-button'><i class='delete-job icon fa fa-trash'></i></span><span class='inner-button'><i class='restart-job icon fa fa-refresh'></i></span></div>")
+    }
+
+    return active_jobs
+}
+
 var poll_jobs = function(repeat){
 
     var success = function(resp){
         if (resp.length == 0){
-            setTimeout(poll_jobs, (36000*5)) // 5 minutes.
-        }else{
-            $('#joblist').empty()
-
-            var active_jobs = []
-
-            for (var i=0; i<resp.length; i++){
-                var j = resp[i]
-                jobs[j.jobid] = j
-                if (j.status == 'queued'){
-                    icon = 'fa fa-ellipsis-v'
-                    active_jobs.push(j.job_id)
-                }else if (j.status == 'running'){
-                    icon = 'fa fa-spinner fa-spin'
-                    active_jobs.push(j.job_id)
-                }else if (j.status == 'finished'){
-                    icon = 'fa fa-check'
-                }else if (j.status == 'failed'){
-                    icon = 'fa fa-exclamation-circle'
-                }else{
-                    icon = 'fa fa-questionmark'
-                }
-
-                var name = j.scenario_name
-                if (name == '' || name == undefined || name == null){
-                    name = app_dict[j.app_id]['name'];
-                }
-                $('#joblist').append("<div class='btn jobstatus "+j.status+"' data-toggle='modal' data-target='#job_status_modal' scenario_id='"+j.scenario_id+"' job-id='"+j.jobid+"' app-id='"+j.app_id+"'><div class='name'>"+name+"</div><span class='icon'><i class='"+icon+"'></i></span><span class='inner-button'><i class='delete-job icon fa fa-trash'></i></span><span class='inner-button'><i class='restart-job icon fa fa-refresh'></i></span></div>")
+            if (job_stream == null){
+                setTimeout(poll_jobs, (36000*5)) // 5 minutes.
             }
-            if (active_jobs.length > 0 && (repeat==undefined || repeat == true)){
+        }else{
+            var active_jobs = render_jobs(resp)
+            if (active_jobs.length > 0 && job_stream == null && (repeat==undefined || repeat == true)){
                 setTimeout(poll_jobs, 5000) // 5 Seconds when there are active jobs
             }
         }
@@ -239,6 +251,70 @@ var poll_jobs = function(repeat){
     )
 }
 
+/* Follow job status changes pushed by the server. Returns false if the
+ * browser cannot do this, in which case the job list needs to be polled.*/
+var watch_jobs = function(){
+    if (typeof(EventSource) == 'undefined'){
+        return false
+    }
+    if (job_stream != null){
+        return true
+    }
+
+    var job_order = []
+
+    var show_jobs = function(){
+        render_jobs(job_order.map(function(jobid){return jobs[jobid]}))
+    }
+
+    // Filters which are not set are left out, as the server would take an
+    // empty parameter for a filter of its own
+    var filters = {}
+    if (uid != null){
+        filters.user_id = uid
+    }
+    if (network_id != null){
+        filters.network_id = network_id
+    }
+    job_stream = new EventSource(job_status_stream_url + '?' + $.param(filters))
+
+    job_stream.addEventListener('snapshot', function(e){
+        var resp = JSON.parse(e.data)
+        jobs = {}
+        job_order = resp.map(function(j){return j.jobid})
+        render_jobs(resp)
+    })
+
+    job_stream.addEventListener('status', function(e){
+        var j = JSON.parse(e.data)
+        var idx = job_order.indexOf(j.jobid)
+        if (j.status == 'deleted'){
+            delete jobs[j.jobid]
+            if (idx >= 0){
+                job_order.splice(idx, 1)
+            }
+        }else{
+            jobs[j.jobid] = j
+            if (idx < 0){
+                job_order.unshift(j.jobid)
+            }
+        }
+        show_jobs()
+    })
+
+    job_stream.addEventListener('progress', function(e){
+        var j = JSON.parse(e.data)
+        if (jobs[j.jobid] != undefined){
+            jobs[j.jobid].progress = j.progress
+        }
+        if ($('#job_id_container').text() == j.jobid && j.progress[1] != null){
+            $('#job_status_progress_bar').css('width', (j.progress[0]/j.progress[1] * 100)+'%')
+        }
+    })
+
+    return true
+}
+
 $(document).on('click', '#refresh-jobs', function(e){
     e.stopPropagation()
     poll_jobs(false)
@@ -364,7 +440,9 @@ var delete_job = function(job_id){
 var restart_job = function(job_id){
     console.log('Restarting job ' + job_id)
     var success = function(resp){
-        poll_jobs()
+        if (job_stream == null){
+            poll_jobs()
+        }
     }
     var error = function(resp){
         alert('An error occurred while restarting job')
@@ -379,5 +457,7 @@ var restart_job = function(job_id){
 }
 
 $(document).ready(function(){
-    poll_jobs(false)
+    if (!watch_jobs()){
+        poll_jobs(false)
+    }
 })
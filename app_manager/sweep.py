@@ -0,0 +1,63 @@
+"""Expand parameter sweeps into job parameters.
+
+A sweep runs an app for every combination of a list of scenarios and the
+values of its options. Option values are given as
+
+    a list of values:  [1, 2, 5]
+    a range:           {'start': 0, 'stop': 1, 'step': 0.25}  (stop included)
+    a single value:    'fixed'
+
+Combinations are generated lazily, so a sweep never has to be held in memory
+as a whole.
+"""
+import itertools
+
+
+def expand_values(spec):
+    """Return the list of values an option takes in a sweep.
+    """
+    if isinstance(spec, dict):
+        start = spec['start']
+        stop = spec['stop']
+        step = spec.get('step', 1)
+        if step <= 0:
+            raise ValueError("The step of a range must be positive.")
+        # Tolerate rounding errors of float steps when including 'stop'
+        count = int((stop - start) / float(step) + 1e-9) + 1
+        if all(isinstance(v, (int, long)) for v in (start, step)):
+            return [start + i * step for i in range(count)]
+        return [round(start + i * step, 12) for i in range(count)]
+    elif isinstance(spec, (list, tuple)):
+        return list(spec)
+    else:
+        return [spec]
+
+
+def sweep_size(scenario_ids, options):
+    """The number of jobs a sweep expands into.
+    """
+    size = len(scenario_ids)
+    for spec in options.values():
+        size *= len(expand_values(spec))
+    return size
+
+
+def iter_sweep(scenario_ids, options):
+    """Yield (scenario id, options) for every job of a sweep.
+    """
+    names = sorted(options)
+    values = [expand_values(options[name]) for name in names]
+    for scenario_id in scenario_ids:
+        for combination in itertools.product(*values):
+            yield scenario_id, dict(zip(names, combination))
+
+
+def batches(iterable, size):
+    """Split `iterable` into lists of at most `size` items.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
@@ -1,7 +1,6 @@
 
-from flask import render_template, session, jsonify, redirect, url_for, request, send_file
+from flask import render_template, session, jsonify, redirect, url_for, request, Response, stream_with_context
 
-import zipfile
 import os
 import json
 
@@ -9,9 +8,12 @@ from flask_security import login_required
 
 from werkzeug import secure_filename
 
+import time
 import datetime
 
 from app_registry import AppInterface
+from file_delivery import send_stream, send_conditional, accepts_gzip, is_compressible
+from metrics import REGISTRY, HTTP_DURATION, HTTP_RESPONSE_SIZE
 appinterface = AppInterface()
 
 import logging
@@ -19,6 +21,27 @@ log = logging.getLogger(__name__)
 
 from . import appmanager
 
+@appmanager.before_request
+def _start_timer():
+    request.started_at = time.time()
+
+@appmanager.after_request
+def _record_request(response):
+    started_at = getattr(request, 'started_at', None)
+    if started_at is not None:
+        HTTP_DURATION.observe(time.time() - started_at, endpoint=request.endpoint)
+    if response.content_length is not None:
+        HTTP_RESPONSE_SIZE.observe(response.content_length, endpoint=request.endpoint)
+    return response
+
+@appmanager.route('/metrics', methods=['GET'])
+def metrics():
+    """The app manager's metrics in the Prometheus text format. Not behind
+    a login so a Prometheus server can scrape it; it holds no user data.
+    """
+    return Response(REGISTRY.render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @appmanager.route('/apps/')
 @login_required
 def go_apps():
@@ -35,20 +58,35 @@ def go_app(app_id):
 @appmanager.route('/apps/upload_app', methods=['POST'])
 @login_required
 def do_upload_app():
-    # Do some stuff
+    """Install an app package, a zip file of app folders. The package is
+    saved and the request answered right away; checking, extracting and
+    registering the apps happens in the background. How far it got is
+    returned by /apps/install/<install_id>.
+    """
 
     app_zip = request.files['app_folder']
 
-    install_path = appinterface.app_registry.install_path
-    save_loc = os.path.join(install_path, app_zip.filename)
+    install_id = appinterface.install_app(app_zip.stream,
+                                          secure_filename(app_zip.filename))
 
-    app_zip.save(save_loc)
+    return redirect(url_for('app_manager.go_apps', install=install_id))
 
-    zip_ref = zipfile.ZipFile(save_loc, 'r')
-    zip_ref.extractall(install_path)
-    zip_ref.close()
+@appmanager.route('/apps/install/<install_id>', methods=['GET'])
+@login_required
+def get_install_status(install_id):
+    """Returns the state of an app installation, like
 
-    return redirect(url_for('app_manager.go_apps'))
+        {"id": "...", "filename": "my_app.zip", "state": "installed",
+         "folders": ["my_app"], "apps": ["a8f43cfadc154b1dfbc98aa13aca38b8"],
+         "submitted_at": "...", "finished_at": "..."}
+
+    where the state is queued, installing, installed or failed, with the
+    reason of a failure under "error".
+    """
+    status = appinterface.install_status(install_id)
+    if not status:
+        return jsonify(status), 404
+    return jsonify(status)
 
 @appmanager.route('/apps/delete_app')
 @login_required
@@ -98,12 +136,14 @@ def run_app():
     {'id': 'the app id',
      'network_id': number,
      'scenario_id': number,
-     'options': {'option1': value1, 'option2': value2, ... }
+     'options': {'option1': value1, 'option2': value2, ... },
+     'priority': 'low', 'normal' or 'high'
      }
 
     'options' is allowed to be empty; entries in the options dict need to
     correspond to a 'name' of a mandatory or non-mandatory argument or a switch
-    of an app.
+    of an app. 'priority' is optional and defaults to 'normal'. It only orders
+    the jobs of one user; users get their turns regardless of priorities.
     """
 
     try:
@@ -116,25 +156,110 @@ def run_app():
     log.info('Running App %s with parameters %s' , parameters['id'], parameters)
  
     if isinstance(parameters['scenario_id'], list):
-        for s_id in parameters['scenario_id']:
-            job_id = appinterface.run_app(parameters['id'],
-                                  parameters['network_id'],
-                                  s_id,
-                                  session['hydra_user_id'],
-                                  options=parameters['options'],
-                                  scenario_name=parameters.get('scenario_name'),
-                                  network_name=parameters.get('network_name')
-                                         )
+        job_ids = appinterface.run_batch(parameters['id'],
+                                         parameters['network_id'],
+                                         parameters['scenario_id'],
+                                         session['hydra_user_id'],
+                                         options=parameters['options'],
+                                         network_name=parameters.get('network_name'),
+                                         scenario_names=parameters.get('scenario_name'),
+                                         priority=parameters.get('priority'))
+        job_id = dict(jobid=job_ids['jobids'][-1], jobids=job_ids['jobids'])
 
     else:
         job_id = appinterface.run_app(parameters['id'],
                                   parameters['network_id'],
                                   parameters['scenario_id'],
                                   session['hydra_user_id'],
-                                  options=parameters['options'])
+                                  options=parameters['options'],
+                                  priority=parameters.get('priority'))
 
     return jsonify(job_id)
 
+@appmanager.route('/app/run_batch', methods=['POST'])
+@login_required
+def run_batch():
+    """Run an app for a list of scenarios with a single request. The
+    parameters are transmitted as a json string:
+    {'id': 'the app id',
+     'network_id': number,
+     'scenario_id': [number, number, ...],
+     'scenario_name': ['name', 'name', ...],
+     'network_name': 'name',
+     'options': {'option1': value1, 'option2': value2, ... },
+     'priority': 'low', 'normal' or 'high'
+     }
+
+    'scenario_name' may also be a single name for all scenarios or be left
+    out, as may 'network_name', 'options' and 'priority'. Returns the ids of all jobs as
+        {'jobids': ['job id', ...]}
+    """
+
+    parameters = json.loads(request.get_data())
+
+    log.info('Running App %s for %s scenarios', parameters['id'], len(parameters['scenario_id']))
+
+    job_ids = appinterface.run_batch(parameters['id'],
+                                     parameters['network_id'],
+                                     parameters['scenario_id'],
+                                     session['hydra_user_id'],
+                                     options=parameters.get('options', {}),
+                                     network_name=parameters.get('network_name', ''),
+                                     scenario_names=parameters.get('scenario_name'),
+                                     priority=parameters.get('priority'))
+
+    return jsonify(job_ids)
+
+@appmanager.route('/app/sweep', methods=['POST'])
+@login_required
+def run_sweep():
+    """Run an app for every combination of scenarios and option values. The
+    parameters are transmitted as a json string:
+    {'id': 'the app id',
+     'network_id': number,
+     'scenario_id': [number, number, ...],
+     'options': {'option1': [value1, value2, ...],
+                 'option2': {'start': 0, 'stop': 10, 'step': 2},
+                 'option3': value, ... }
+     }
+
+    'scenario_name', 'network_name' and 'priority' may be given as for
+    /app/run_batch.
+    Returns the id of the sweep and the number of jobs it was expanded into:
+        {'sweep_id': 'sweep id', 'jobs': 600}
+    """
+
+    parameters = json.loads(request.get_data())
+
+    scenario_ids = parameters['scenario_id']
+    if not isinstance(scenario_ids, list):
+        scenario_ids = [scenario_ids]
+
+    log.info('Sweeping App %s with parameters %s', parameters['id'], parameters)
+
+    sweep = appinterface.run_sweep(parameters['id'],
+                                   parameters['network_id'],
+                                   scenario_ids,
+                                   session['hydra_user_id'],
+                                   options=parameters.get('options', {}),
+                                   network_name=parameters.get('network_name', ''),
+                                   scenario_names=parameters.get('scenario_name'),
+                                   priority=parameters.get('priority'))
+
+    return jsonify(sweep)
+
+@appmanager.route('/app/sweep/<sweep_id>', methods=['GET'])
+@login_required
+def sweep_status(sweep_id):
+    """Get the progress of a sweep, as in
+        {'sweep_id': 'sweep id',
+         'jobs': 600,
+         'counts': {'queued': 500, 'running': 8, 'finished': 92},
+         'progress': 0.16}
+    """
+
+    return jsonify(appinterface.get_sweep_status(sweep_id))
+
 def _parse_args(args, files):
     params = {
         'options': {} 
@@ -151,6 +276,8 @@ def _parse_args(args, files):
             params['network_id'] = v
         elif k.find('scenario') == 0:
             params['scenario_id'] = v
+        elif k == 'priority':
+            params['priority'] = v
         else:
             params['options'][k] = v
 
@@ -186,12 +313,39 @@ def job_status():
 
     Here, the user_id needs to be sent explicitly because it is allowed to be
     empty/non-existent.
+
+    Network and user queries may also be filtered and paged with
+        "status": "running" or ["queued", "running"],
+        "app_id": "app id",
+        "since": "2016-03-01", "until": "2016-03-02 12:00",
+        "limit": 50,
+        "cursor": "cursor returned with the previous page"
+    in which case the response is
+        {"jobs": [...], "cursor": "cursor of the next page or null"}
     """
 
     parameters = json.loads(request.get_data())
 
     log.info('Polling jobs for: %s', parameters)
 
+    paged = any(parameters.get(p) is not None for p in
+                ('status', 'app_id', 'since', 'until', 'limit', 'cursor'))
+    if paged and parameters.get('job_id') is None:
+        try:
+            limit = _limit(parameters)
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+        jobs, cursor = \
+            appinterface.query_status(network_id=parameters.get('network_id'),
+                                      user_id=parameters.get('user_id'),
+                                      app_id=parameters.get('app_id'),
+                                      status=parameters.get('status'),
+                                      since=parameters.get('since'),
+                                      until=parameters.get('until'),
+                                      cursor=parameters.get('cursor'),
+                                      limit=limit)
+        return jsonify(jobs=jobs, cursor=cursor)
+
     status = \
         appinterface.get_status(network_id=parameters.get('network_id', None),
                                 user_id=parameters.get('user_id', None),
@@ -199,6 +353,107 @@ def job_status():
 
     return jsonify(status)
 
+@appmanager.route('/app/archive', methods=['POST'])
+@login_required
+def archived_jobs():
+    """Get the archived jobs of a network and/or user, most recent first, by
+    transmitting a json string like
+        '{"network_id": "3", "user_id": "2",
+          "since": "2016-03-01", "until": "2016-04-01", "limit": 100}'
+    where all entries are optional.
+    """
+
+    parameters = json.loads(request.get_data())
+
+    log.info('Querying archived jobs for: %s', parameters)
+
+    try:
+        limit = _limit(parameters)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    archived = \
+        appinterface.get_archived_jobs(network_id=parameters.get('network_id'),
+                                       user_id=parameters.get('user_id'),
+                                       since=parameters.get('since'),
+                                       until=parameters.get('until'),
+                                       limit=limit)
+
+    return jsonify(archived)
+
+def _limit(parameters):
+    """The "limit" of a query as a positive number, which may be sent as a
+    string like the other parameters. None if there is no limit.
+    """
+    limit = parameters.get('limit')
+    if limit is None or limit == '':
+        return None
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid limit %s, expected a number." % (limit,))
+    if limit < 1:
+        raise ValueError("Invalid limit %s, expected at least 1." % limit)
+    return limit
+
+@appmanager.route('/app/status/stream', methods=['GET'])
+@login_required
+def job_status_stream():
+    """Stream status changes of the jobs of a network and/or user as
+    server-sent events. The filters are passed as query parameters, as in
+        /app/status/stream?network_id=3&user_id=2
+
+    The stream starts with a 'snapshot' event holding the same list
+    /app/status returns. After that, a 'status' event is sent whenever a job
+    changes state (the status of removed jobs is 'deleted') and a 'progress'
+    event whenever a running job reports progress.
+    """
+
+    # An empty parameter is no filter, as in /app/status
+    network_id = request.args.get('network_id') or None
+    user_id = request.args.get('user_id') or None
+
+    log.info('Streaming jobs for: network %s, user %s', network_id, user_id)
+
+    return Response(stream_with_context(_status_events(network_id, user_id)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+def _status_events(network_id, user_id):
+    feed = appinterface.job_events
+
+    seq = None
+    while True:
+        if seq is None:
+            # (Re)start with a full snapshot. This is also necessary if the
+            # client has fallen further behind than the feed's backlog.
+            seq = feed.seq
+            status = appinterface.get_status(network_id=network_id, user_id=user_id)
+            yield _sse('snapshot', status, seq)
+
+        events, last = feed.wait(seq)
+        if events and events[0][0] > seq + 1:
+            seq = None
+            continue
+
+        for event_seq, (event, row) in events:
+            if _row_matches(row, network_id, user_id):
+                yield _sse(event, row, event_seq)
+        if not events:
+            yield ': heartbeat\n\n'
+        seq = last
+
+def _row_matches(row, network_id, user_id):
+    if network_id is not None and str(row['network_id']) != str(network_id):
+        return False
+    if user_id is not None and str(row['owner']) != str(user_id):
+        return False
+    return network_id is not None or user_id is not None
+
+def _sse(event, data, seq):
+    return 'id: %s\nevent: %s\ndata: %s\n\n' % (seq, event, json.dumps(data))
+
 @appmanager.route('/app/details/<job_id>', methods=['GET'])
 @appmanager.route('/job/<job_id>',         methods=['GET'])
 @appmanager.route('/app/details/',         methods=['POST'])
@@ -217,6 +472,24 @@ def job_details(job_id):
 
     return jsonify(details)
 
+@appmanager.route('/app/tail/<job_id>', methods=['GET'])
+@login_required
+def job_tail(job_id):
+    """Get what a job has logged and output since the last call. Pass the
+    'log_offset' and 'out_offset' of the previous response as query
+    parameters to continue from there, as in
+        /app/tail/<job_id>?log_offset=1024&out_offset=2048
+    Without 'log_offset', the last 'lines' (default 100) lines of the log are
+    returned.
+    """
+
+    log_offset = request.args.get('log_offset', None, type=int)
+    out_offset = request.args.get('out_offset', 0, type=int)
+    limit = request.args.get('lines', 100, type=int)
+
+    return jsonify(appinterface.tail_job(job_id, log_offset=log_offset,
+                                         out_offset=out_offset, limit=limit))
+
 @appmanager.route('/job/delete/<job_id>', methods=['GET' ])
 @appmanager.route('/job/delete/',         methods=['POST'])
 @login_required
@@ -271,7 +544,10 @@ def native_logs(job_id):
     if isinstance(nativelogs, str):
         return nativelogs
 
-    return send_file(nativelogs.name, attachment_filename=nativelogs.name.split(os.sep)[-1], as_attachment=True)
+    if nativelogs.is_cached:
+        return send_conditional(nativelogs.path, nativelogs.filename)
+
+    return send_stream(nativelogs.generate(), nativelogs.filename, compress=accepts_gzip())
 
 @appmanager.route('/app/nativeoutput', methods=['GET'])
 @appmanager.route('/app/nativeoutput/<job_id>', methods=['GET'])
@@ -290,4 +566,6 @@ def native_output(job_id):
     if isinstance(nativeoutput, str):
         return nativeoutput
 
-    return send_file(nativeoutput,attachment_filename=nativeoutput.name.split(os.sep)[-1], as_attachment=True)
+    gzipped = nativeoutput if is_compressible(nativeoutput.filename) else None
+
+    return send_conditional(nativeoutput.source, nativeoutput.filename, gzipped=gzipped)
@@ -0,0 +1,305 @@
+"""Benchmarks of the app manager's hot paths.
+
+Generates a tree of plugins and job queues of several sizes (see
+synthetic.py), then times the operations behind the web UI on them, both
+directly and through the Flask test client:
+
+    JobQueue.rebuild        from job files, from the journal, from a snapshot
+    JobQueue.refresh        with nothing changed
+    AppInterface.get_status / query_status
+    Job.get_details         for logs of each size
+    scan_installed_apps     parsing every plugin.xml, and from the cache
+    App.cli_command
+
+Results are written as JSON, times in seconds per call:
+
+    {"meta": {"started_at": "...", "commit": "...", "python": "...", ...},
+     "results": [{"name": "get_status.user", "jobs": 10000, "repeat": 5,
+                  "min": 0.0121, "median": 0.0130, "mean": 0.0131,
+                  "max": 0.0152}, ...]}
+
+With --compare, the medians are compared to those of an earlier run.
+Generated queues are kept in --workdir, if given, and reused by later runs.
+
+Usage:
+    python benchmarks/run.py --jobs 1000,10000,100000 --output before.json
+    python benchmarks/run.py --jobs 1000,10000 --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from datetime import datetime
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import synthetic
+
+from hydra_base import config
+
+
+log = logging.getLogger('benchmarks')
+
+
+def configure(**options):
+    """Set options of the [plugin] section of the hydra config, which the
+    app manager reads when it is imported and in AppInterface().
+    """
+    if config.CONFIG is None:
+        config.load_config()
+    if not config.CONFIG.has_section('plugin'):
+        config.CONFIG.add_section('plugin')
+    for option, value in options.items():
+        config.CONFIG.set('plugin', option, str(value))
+
+
+def measure(func, repeat, number=1, setup=None):
+    """Call `func` `number` times, `repeat` times over, and return the
+    statistics of the time per call. `setup` is called, untimed, before
+    each repetition.
+    """
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.time()
+        for j in range(number):
+            func()
+        times.append((time.time() - started) / number)
+    times.sort()
+    middle = len(times) // 2
+    median = times[middle] if len(times) % 2 else \
+            (times[middle - 1] + times[middle]) / 2
+    return dict(repeat=repeat, number=number, min=times[0], median=median,
+                mean=sum(times) / len(times), max=times[-1])
+
+
+class Benchmarks(object):
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = []
+
+    def run(self, name, func, jobs=None, **kwargs):
+        kwargs.setdefault('repeat', self.repeat)
+        result = dict(name=name, jobs=jobs)
+        result.update(measure(func, **kwargs))
+        self.results.append(result)
+        log.info("%-28s %8s jobs  median %10.6fs  min %10.6fs", name,
+                 jobs if jobs is not None else '-', result['median'],
+                 result['min'])
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=REPO).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_client(blueprint):
+    """A Flask test client for the app manager, logins disabled.
+    """
+    import flask
+    from flask_login import LoginManager
+
+    app = flask.Flask(__name__)
+    app.config['LOGIN_DISABLED'] = True
+    LoginManager(app)
+    app.register_blueprint(blueprint)
+    return app.test_client()
+
+
+def bench_apps(bench, apps, plugin_path, workdir, client):
+    from app_manager.app_registry import scan_installed_apps
+    from app_manager.registry_cache import RegistryCache
+
+    bench.run('scan_installed_apps.parse',
+              lambda: scan_installed_apps(plugin_path))
+    cache_path = os.path.join(workdir, 'bench_registry_cache.json')
+    scan_installed_apps(plugin_path, cache=RegistryCache(cache_path))
+    bench.run('scan_installed_apps.cached',
+              lambda: scan_installed_apps(plugin_path,
+                                          cache=RegistryCache(cache_path)))
+
+    app_id, app = sorted(apps.items())[0]
+    options = dict(('option%s' % i, i) for i in range(5))
+    options['verbose'] = True
+    bench.run('cli_command',
+              lambda: app.cli_command(app_id, 1, 2, options), number=1000)
+
+    bench.run('http.installed', lambda: client.get('/apps/installed'))
+
+
+def bench_queue(bench, count, root, detail, client, views):
+    from app_manager.app_registry import AppInterface, JobQueue
+
+    registry = views.appinterface.app_registry
+    journal = [os.path.join(root, name)
+               for name in ('journal.log', 'journal.snapshot')]
+
+    def remove_journal():
+        for path in journal:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def rebuild():
+        JobQueue(root).rebuild(registry)
+
+    # Rebuilding from the job files leaves a journal of all jobs behind
+    bench.run('rebuild.files', rebuild, jobs=count, setup=remove_journal)
+    bench.run('rebuild.journal', rebuild, jobs=count)
+    JobQueue(root).journal.compact(force=True)
+    bench.run('rebuild.snapshot', rebuild, jobs=count)
+
+    views.appinterface = ai = AppInterface()
+    # A retention pass would read every completed job file in the
+    # background while we measure.
+    ai.retention.start = lambda: None
+
+    bench.run('refresh.idle', lambda: ai.job_queue.refresh(ai.app_registry),
+              jobs=count)
+    bench.run('get_status.user', lambda: ai.get_status(user_id=0),
+              jobs=count)
+    bench.run('get_status.network', lambda: ai.get_status(network_id=1),
+              jobs=count)
+    bench.run('query_status.page',
+              lambda: ai.query_status(user_id=0, limit=50), jobs=count)
+    bench.run('query_status.running',
+              lambda: ai.query_status(user_id=0, status='running', limit=50),
+              jobs=count)
+
+    for label, job_ids in sorted(detail.items(),
+                                 key=lambda item: synthetic.parse_size(item[0])):
+        # A different job for every call, so none of them finds the log
+        # markers cached by an earlier one
+        jobs = iter(job_ids[::2])
+        bench.run('get_details.%s' % label,
+                  lambda: ai.get_job_details(next(jobs)), jobs=count)
+        jobs = iter(job_ids[1::2])
+        bench.run('http.details.%s' % label,
+                  lambda: client.get('/app/details/%s' % next(jobs)),
+                  jobs=count)
+
+    bench.run('http.status.user',
+              lambda: client.post('/app/status',
+                                  data=json.dumps(dict(user_id=0))),
+              jobs=count)
+    bench.run('http.status.page',
+              lambda: client.post('/app/status',
+                                  data=json.dumps(dict(user_id=0, limit=50))),
+              jobs=count)
+
+
+def compare(results, path):
+    with open(path, 'r') as f:
+        previous = dict(((r['name'], r['jobs']), r)
+                        for r in json.load(f)['results'])
+    # On stderr, stdout may hold the results
+    out = sys.stderr
+    out.write('%-28s %8s %12s %12s %8s\n' % ('benchmark', 'jobs', 'before',
+                                            'after', 'change'))
+    for result in results:
+        before = previous.get((result['name'], result['jobs']))
+        if before is None:
+            continue
+        out.write('%-28s %8s %12.6f %12.6f %+7.1f%%\n' % (
+            result['name'], result['jobs'] if result['jobs'] is not None
+            else '-', before['median'], result['median'],
+            100. * (result['median'] - before['median']) / before['median']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--jobs', default='1000,10000,100000',
+                        help="Sizes of the job queues to benchmark.")
+    parser.add_argument('--apps', type=int, default=50,
+                        help="Number of installed apps.")
+    parser.add_argument('--log-sizes', default='1K,100K,10M',
+                        help="Sizes of the job logs read by get_details.")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Repetitions of each benchmark.")
+    parser.add_argument('--workdir',
+                        help="Where to generate plugins and job queues, "
+                             "reusing any generated earlier. Defaults to a "
+                             "temporary folder which is removed afterwards.")
+    parser.add_argument('--output', default='-',
+                        help="File to write the results to, - for stdout.")
+    parser.add_argument('--compare',
+                        help="Results of an earlier run to compare to.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    log.setLevel(logging.INFO)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='appmanager-bench-')
+    counts = [int(count) for count in args.jobs.split(',')]
+    log_sizes = args.log_sizes.split(',')
+    sizes = dict((synthetic.parse_size(label), label) for label in log_sizes)
+    # Jobs read by the get_details benchmarks, a fresh one for every call
+    detail_jobs = 2 * args.repeat
+
+    plugin_path = os.path.join(workdir, 'plugins-%s' % args.apps)
+    synthetic.make_plugins(plugin_path, args.apps)
+    configure(default_directory=plugin_path,
+              queue_directory=os.path.join(workdir, 'empty-queue'),
+              upload_dir=os.path.join(workdir, 'uploads'),
+              registry_cache=os.path.join(workdir, 'registry_cache.json'))
+
+    from app_manager import appmanager, views
+    from app_manager.app_registry import JobQueue
+
+    meta = dict(started_at=datetime.now().isoformat(), commit=_commit(),
+                python=sys.version.split()[0], platform=platform.platform(),
+                args=vars(args))
+    bench = Benchmarks(args.repeat)
+    client = make_client(appmanager)
+    apps = views.appinterface.app_registry.installed_apps
+    try:
+        bench_apps(bench, apps, plugin_path, workdir, client)
+
+        for count in counts:
+            root = os.path.join(workdir, 'queue-%s' % count)
+            params = synthetic.spool_params(apps, count, sizes.keys(),
+                                            detail_jobs)
+            detail = synthetic.load_spool(root, params)
+            if detail is None:
+                if os.path.exists(root):
+                    shutil.rmtree(root)
+                started = time.time()
+                detail = synthetic.make_spool(JobQueue(root), apps, count,
+                                              sizes.keys(), detail_jobs)
+                log.info("Generated a queue of %s jobs in %.1fs", count,
+                         time.time() - started)
+            configure(queue_directory=root)
+            bench_queue(bench, count, root,
+                        dict((sizes[int(size)], job_ids)
+                             for size, job_ids in detail.items()),
+                        client, views)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = dict(meta=meta, results=bench.results)
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(bench.results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
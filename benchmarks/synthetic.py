@@ -0,0 +1,191 @@
+"""Synthetic plugin trees and job queues for the benchmarks.
+
+Plugins are plain plugin.xml files. Job queues are written through
+JobQueue.enqueue_many, so job files, logs and the journal look exactly like
+those of a real server, and jobs are then moved into the other state folders
+the way the queue runner moves them.
+"""
+import os
+import json
+import random
+import itertools
+
+
+PLUGIN_XML = """<plugin_info>
+    <plugin_name>Benchmark app %(n)s</plugin_name>
+    <plugin_description>A synthetic app for benchmarks.</plugin_description>
+    <plugin_category>benchmark</plugin_category>
+    <plugin_command>run.sh</plugin_command>
+    <plugin_shell>bash</plugin_shell>
+    <plugin_location>.</plugin_location>
+    <plugin_nativelogextension>lst</plugin_nativelogextension>
+    <plugin_nativeoutputextension>csv</plugin_nativeoutputextension>
+    <plugin_resources>
+        <cpus>%(cpus)s</cpus>
+        <memory>%(memory)sM</memory>
+    </plugin_resources>
+    <mandatory_args>
+        <arg><name>network_id</name><switch>-t</switch></arg>
+        <arg><name>scenario_id</name><switch>-s</switch></arg>
+    </mandatory_args>
+    <non_mandatory_args>
+%(args)s
+    </non_mandatory_args>
+    <switches>
+        <arg><name>verbose</name><switch>-v</switch></arg>
+        <arg><name>debug</name><switch>--debug</switch></arg>
+    </switches>
+</plugin_info>
+"""
+
+ARG_XML = "        <arg><name>option%s</name><switch>--option%s</switch></arg>"
+
+# Where the jobs of a queue end up, as (folder, share of the jobs)
+STATE_SHARES = (('queued', .10),
+                ('running', .02),
+                ('finished', .70),
+                ('failed', .10),
+                ('deleted', .08))
+
+SPOOL_MARKER = '.benchmark-spool'
+
+
+def make_plugins(path, count, args=10):
+    """Write `count` apps with `args` optional arguments each into `path`.
+    """
+    for n in range(count):
+        folder = os.path.join(path, 'app_%04d' % n)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(os.path.join(folder, 'plugin.xml'), 'w') as f:
+            f.write(PLUGIN_XML % dict(
+                n=n, cpus=1 + n % 4, memory=256 * (1 + n % 8),
+                args='\n'.join(ARG_XML % (i, i) for i in range(args))))
+        with open(os.path.join(folder, 'run.sh'), 'w') as f:
+            f.write('#!/bin/bash\nsleep 1\n')
+
+
+def parse_size(value):
+    """'64K', '10M' -> bytes.
+    """
+    units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = str(value).strip().upper().rstrip('B')
+    number = value.rstrip('KMG')
+    return int(float(number) * units[value[len(number):]])
+
+
+def write_log(path, size, output=False):
+    """Write about `size` bytes of solver-like log lines to `path`. Outputs
+    carry the progress and output markers jobs print.
+    """
+    written = 0
+    n = 0
+    lines = []
+    with open(path, 'w') as f:
+        while written < size:
+            if output and n % 50 == 0:
+                line = '!!Progress %s/%s\n' % (n, size // 30)
+            elif output and n % 500 == 1:
+                line = '!!Output result_%s.csv\n' % n
+            else:
+                line = 'iteration %8d objective %.6f\n' % (n, 1e6 / (n + 1))
+            lines.append(line)
+            written += len(line)
+            n += 1
+            if len(lines) == 1000:
+                f.write(''.join(lines))
+                lines = []
+        f.write(''.join(lines))
+
+
+def load_spool(root, params):
+    """The detail jobs of the queue in `root` if it is complete and was
+    generated with `params`, so it can be reused. Otherwise None.
+    """
+    try:
+        with open(os.path.join(root, SPOOL_MARKER), 'r') as f:
+            spool = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if spool.get('params') != params:
+        return None
+    return dict((size, job_ids) for size, job_ids in spool['detail'])
+
+
+def spool_params(apps, count, log_sizes, detail_jobs=5, owners=20,
+                 networks=100, seed=0):
+    return dict(apps=len(apps), count=count, log_sizes=sorted(log_sizes),
+                detail_jobs=detail_jobs, owners=owners, networks=networks,
+                seed=seed)
+
+
+def make_spool(job_queue, apps, count, log_sizes, detail_jobs=5, owners=20,
+               networks=100, seed=0, batch_size=1000):
+    """Fill `job_queue` with `count` jobs of `apps` (app id -> App), spread
+    over the state folders by STATE_SHARES. Jobs which ran get a log and
+    output of the smallest of `log_sizes` bytes; `detail_jobs` finished jobs
+    per size get one of that size.
+
+    Returns the ids of these jobs as a dict of size -> job ids, which
+    `load_spool` returns as well once the queue is complete.
+    """
+    # Only imported here: importing app_manager reads the hydra config,
+    # which run.py sets up first.
+    from app_manager.app_registry import Job
+
+    rand = random.Random(seed)
+    app_ids = sorted(apps)
+    job_ids = []
+    while len(job_ids) < count:
+        jobs = []
+        for i in range(min(batch_size, count - len(job_ids))):
+            app_id = rand.choice(app_ids)
+            network_id = rand.randrange(networks)
+            scenario_id = rand.randrange(10 * networks)
+            options = dict(('option%s' % k, rand.randrange(1000))
+                           for k in range(rand.randrange(5)))
+            job = Job()
+            job.create(apps[app_id], app_id, network_id, scenario_id,
+                       rand.randrange(owners), options,
+                       network_name='Network %s' % network_id,
+                       scenario_name='Scenario %s' % scenario_id,
+                       priority=rand.choice(('low', 'normal', 'normal',
+                                             'high')))
+            jobs.append(job)
+        job_queue.enqueue_many(jobs)
+        job_ids.extend(job.id for job in jobs)
+
+    rand.shuffle(job_ids)
+    folders = dict()
+    start = 0
+    for folder, share in STATE_SHARES:
+        end = start + int(round(share * count))
+        folders[folder] = job_ids[start:end]
+        start = end
+    folders['queued'].extend(job_ids[start:])
+
+    sizes = sorted(log_sizes)
+    detail = dict()
+    log_size = dict()
+    finished = iter(folders['finished'])
+    for size in sizes:
+        detail[size] = list(itertools.islice(finished, detail_jobs))
+        log_size.update((job_id, size) for job_id in detail[size])
+
+    root = job_queue.root
+    logs = os.path.join(root, job_queue.folders['logs'])
+    for folder in ('running', 'finished', 'failed', 'deleted'):
+        for job_id in folders[folder]:
+            os.rename(os.path.join(root, 'queued', job_id + '.job'),
+                      os.path.join(root, folder, job_id + '.job'))
+            job_queue.journal.moved(job_id, folder)
+            size = log_size.get(job_id, sizes[0])
+            write_log(os.path.join(logs, job_id + '.log'), size)
+            write_log(os.path.join(logs, job_id + '.out'), size, output=True)
+
+    with open(os.path.join(root, SPOOL_MARKER), 'w') as f:
+        json.dump(dict(params=spool_params(apps, count, log_sizes,
+                                           detail_jobs, owners, networks,
+                                           seed),
+                       detail=sorted(detail.items())), f)
+    return detail